@@ -0,0 +1,65 @@
+# Rewriting of gzipped log files without the lines matching grep patterns,
+# shared by the zeek_purge_*_from_data.sh scripts. The sourcing script
+# provides the log function and sets BACKUP for -b. The temporary file being
+# written is kept in temp_file for the cleanup trap of the script.
+
+# Compress with pigz, which compresses the blocks of a file on all cores, when
+# it is installed
+if command -v pigz >/dev/null 2>&1; then
+    COMPRESS=(pigz -6)
+else
+    COMPRESS=(gzip -6)
+fi
+
+# Function to pass lines through while counting them into a file, written
+# once the input ends
+count_lines() {
+    awk -v count_file="$1" '{ print } END { print NR > count_file }'
+}
+
+# Function to rewrite a log file without the lines matching the grep patterns
+# given after it. The file is read once: the kept lines are compressed to a
+# temporary file next to the original, and only if lines were removed is it
+# synced to disk and renamed over the original, so the original is only ever
+# replaced by a complete file. With -b the original is kept as a hard link,
+# ${file}.bak, instead of a copy.
+rewrite_file() {
+    local file=$1
+    shift
+
+    temp_file=$(mktemp "$(dirname "$file")/.$(basename "$file").XXXXXX") || { log "Failed to create temporary file for $file"; return 1; }
+    local counts
+    counts=$(mktemp -d) || { log "Failed to create temporary file for $file"; rm -f "$temp_file"; return 1; }
+
+    zcat "$file" | count_lines "$counts/in" | grep -v -F "$@" | count_lines "$counts/out" | "${COMPRESS[@]}" > "$temp_file"
+    local status=("${PIPESTATUS[@]}")
+    local lines_in lines_out
+    lines_in=$(cat "$counts/in" 2>/dev/null)
+    lines_out=$(cat "$counts/out" 2>/dev/null)
+    rm -rf "$counts"
+    # grep exits with 1 when it removed every line
+    if [ "${status[0]}" -ne 0 ] || [ "${status[1]}" -ne 0 ] || [ "${status[2]}" -gt 1 ] \
+        || [ "${status[3]}" -ne 0 ] || [ "${status[4]}" -ne 0 ]; then
+        log "Error processing $file"
+        rm -f "$temp_file"
+        return 1
+    fi
+
+    # Files without matching lines are left untouched
+    if [ "$lines_in" = "$lines_out" ]; then
+        log "No match in $file"
+        rm -f "$temp_file"
+        return 0
+    fi
+    chmod --reference="$file" "$temp_file" && sync "$temp_file" || { log "Failed to write $file"; rm -f "$temp_file"; return 1; }
+
+    if [ -n "$BACKUP" ] && [ ! -e "${file}.bak" ]; then
+        ln "$file" "${file}.bak" || { log "Failed to create backup for $file"; rm -f "$temp_file"; return 1; }
+        log "Created backup for $file"
+    fi
+
+    # Replace the original file with the filtered one
+    mv "$temp_file" "$file" || { log "Failed to replace original file $file"; rm -f "$temp_file"; return 1; }
+    sync "$(dirname "$file")"
+    log "Processed $file, removed $((lines_in - lines_out)) of $lines_in lines"
+}
@@ -1,72 +1,139 @@
 import duckdb
 import argparse
 
-# Function to check if the bytes exceed the maximum possible value
-def check_flow(orig_pkts, orig_bytes, resp_pkts, resp_bytes, max_payload):
-    # Initialize error flags
-    orig_error = False
-    resp_error = False
-
-    # Calculate max possible bytes for origin and response
-    max_orig_bytes = orig_pkts * max_payload
-    max_resp_bytes = resp_pkts * max_payload
-    
-    # Check if orig_bytes exceed the possible maximum (only if orig_bytes is not None)
-    if orig_bytes is not None and orig_bytes > max_orig_bytes:
-        orig_error = True
-    
-    # Check if resp_bytes exceed the possible maximum (only if resp_bytes is not None)
-    if resp_bytes is not None and resp_bytes > max_resp_bytes:
-        resp_error = True
-    
-    return orig_error, resp_error
-
-# Function to log errors found in the flow
-def log_error(log_file, uid, orig_pkts, orig_bytes, resp_pkts, resp_bytes, orig_error, resp_error, max_payload):
-    with open(log_file, "a") as log:
-        log.write(f"UID: {uid}\n")
-        log.write(f"Orig_Pkts: {orig_pkts}, Orig_Bytes: {orig_bytes}, "
-                  f"Resp_Pkts: {resp_pkts}, Resp_Bytes: {resp_bytes}\n")
-        if orig_error:
-            log.write(f"  - Error: Orig Bytes ({orig_bytes}) exceeds max possible ({orig_pkts * max_payload})\n")
-        if resp_error:
-            log.write(f"  - Error: Resp Bytes ({resp_bytes}) exceeds max possible ({resp_pkts * max_payload})\n")
-        log.write("\n")  # Add a newline to separate logs
-
-# Function to process all flows from the database
-def process_flows(db_path, log_file, max_payload):
-    con = duckdb.connect(db_path)
-    
-    cursor = con.execute('SELECT uid, orig_pkts, orig_bytes, resp_pkts, resp_bytes FROM logs')
-    
-    for row in cursor.fetchall():
-        uid, orig_pkts, orig_bytes, resp_pkts, resp_bytes = row
-        
-        orig_error, resp_error = check_flow(orig_pkts, orig_bytes, resp_pkts, resp_bytes, max_payload)
-        
-        if orig_error or resp_error:
-            log_error(log_file, uid, orig_pkts, orig_bytes, resp_pkts, resp_bytes, orig_error, resp_error, max_payload)
-    
-    con.close()
+# Letters of the history of a TCP connection that must, or must not, appear
+# for each conn_state, from the conn_state descriptions of the Zeek conn.log
+# documentation. Upper case letters are packets of the originator, lower case
+# ones of the responder: S/s SYN, H/h SYN-ACK, A/a ACK, D/d data, F/f FIN,
+# R/r RST.
+CONN_STATE_HISTORY = {
+    # Connection attempt seen, no reply
+    'S0': {'forbidden': 'hadfr'},
+    # Connection attempt rejected
+    'REJ': {'required': 'r'},
+    # Originator aborted (sent a RST)
+    'RSTO': {'required': 'R'},
+    # Responder sent a RST
+    'RSTR': {'required': 'r'},
+    # Originator sent a SYN followed by a RST, no SYN-ACK from the responder
+    'RSTOS0': {'required': 'R', 'forbidden': 'h'},
+    # Responder sent a SYN-ACK followed by a RST, no SYN from the originator
+    'RSTRH': {'required': 'r', 'forbidden': 'S'},
+    # Originator sent a SYN followed by a FIN, no SYN-ACK from the responder
+    'SH': {'forbidden': 'h'},
+    # Responder sent a SYN-ACK followed by a FIN, no SYN from the originator
+    'SHR': {'forbidden': 'S'},
+}
+
+
+def history_predicate():
+    """Return the SQL predicate of TCP flows whose history is impossible for their conn_state."""
+    states = []
+    for state, letters in CONN_STATE_HISTORY.items():
+        conditions = [f"NOT contains(history, '{letter}')" for letter in letters.get('required', '')]
+        conditions += [f"contains(history, '{letter}')" for letter in letters.get('forbidden', '')]
+        states.append(f"(conn_state = '{state}' AND ({' OR '.join(conditions)}))")
+    return f"(proto = 'tcp' AND ({' OR '.join(states)}))"
+
+
+# Checks of the flows, each one a SQL predicate over the columns of logs that
+# holds for the flows violating it. max_payload is the largest payload of a
+# packet, the MTU without the TCP/IP headers.
+CHECKS = {
+    # More payload than full-size packets can carry, the Zeek bug of
+    # https://github.com/zeek/zeek/issues/3313. The packets are widened so
+    # that flows of millions of packets do not overflow INTEGER.
+    'orig_bytes_mtu': 'orig_bytes > CAST(orig_pkts AS BIGINT) * {max_payload}',
+    'resp_bytes_mtu': 'resp_bytes > CAST(resp_pkts AS BIGINT) * {max_payload}',
+    'negative_duration': 'duration < 0',
+    # The IP bytes of a direction include its payload and headers
+    'orig_ip_bytes': 'orig_ip_bytes < orig_bytes',
+    'resp_ip_bytes': 'resp_ip_bytes < resp_bytes',
+    # A responder that never answered has no packets
+    'no_reply_pkts': "conn_state = 'S0' AND resp_pkts > 0",
+    'conn_state_history': history_predicate(),
+}
+
+# Columns of the flows written to the report, after the name of the check and
+# the source.
+REPORT_COLUMNS = ['uid', 'ts', 'proto', 'conn_state', 'history', 'duration', 'orig_pkts', 'orig_bytes',
+                  'orig_ip_bytes', 'resp_pkts', 'resp_bytes', 'resp_ip_bytes', 'missed_bytes']
+
+
+def quote(path):
+    """Return a file path as a SQL string literal."""
+    return "'" + path.replace("'", "''") + "'"
+
+
+def report_format(report):
+    """Return the COPY format of a report file, Parquet for a .parquet file and CSV otherwise."""
+    return 'parquet' if report.lower().endswith('.parquet') else 'csv, HEADER'
+
+
+def check_predicates(checks, max_payload):
+    """Return the SQL predicates of the given checks by name."""
+    return {check: f'({CHECKS[check].format(max_payload=max_payload)})' for check in checks}
+
+
+def validate_flows(con, checks, max_payload, report):
+    """
+    Write the flows of logs violating the given checks to the report file,
+    one row per flow and violated check, in a single scan of logs.
+
+    Every check is evaluated by DuckDB over whole vectors of flows, and the
+    violations are streamed to the report as they are found, so memory use
+    does not depend on the number of flows or violations. Returns the
+    number of rows written.
+    """
+    predicates = check_predicates(checks, max_payload)
+    violated = ', '.join(f"CASE WHEN {predicate} THEN '{check}' END" for check, predicate in predicates.items())
+    return con.execute(f'''
+        COPY (
+            SELECT unnest(list_filter([{violated}], name -> name IS NOT NULL)) AS check_name, source,
+                   {', '.join(REPORT_COLUMNS)}
+            FROM logs
+            WHERE {' OR '.join(predicates.values())}
+        ) TO {quote(report)} (FORMAT {report_format(report)})
+    ''').fetchone()[0]
+
+
+def violation_counts(con, checks, max_payload):
+    """
+    Return the number of flows of every source and the number of violations
+    of every check per source, from one aggregate pass over logs.
+    """
+    predicates = check_predicates(checks, max_payload)
+    counts = ', '.join(f'COUNT(*) FILTER (WHERE {predicate})' for predicate in predicates.values())
+    rows = con.execute(f'SELECT source, COUNT(*), {counts} FROM logs GROUP BY source ORDER BY source').fetchall()
+    flows = {row[0]: row[1] for row in rows}
+    return flows, [(check, row[0], row[2 + index]) for index, check in enumerate(checks) for row in rows]
+
 
-# Main function to parse arguments and execute the script
 def main():
-    parser = argparse.ArgumentParser(description="Check network flows for byte discrepancies.")
-    
+    parser = argparse.ArgumentParser(description="Check network flows for byte discrepancies and impossible values.")
     parser.add_argument('--mtu', type=int, default=1500, help='Maximum Transmission Unit (MTU). Default is 1500 bytes.')
     parser.add_argument('--tcp_ip_overhead', type=int, default=40, help='TCP/IP overhead in bytes. Default is 40 bytes.')
-    parser.add_argument('--log_file', type=str, default='flow_errors.log', help='Log file to write errors to. Default is flow_errors.log.')
+    parser.add_argument('--report', '--log_file', dest='report', type=str, default='flow_errors.parquet',
+                        help='File the violations are written to, Parquet if it ends in .parquet and CSV otherwise. '
+                             'Default is flow_errors.parquet.')
+    parser.add_argument('--check', action='append', choices=list(CHECKS),
+                        help='Only run this check (can be repeated). Default is all checks.')
     parser.add_argument('--db', type=str, default='db/ctu-hornet-65-niner_v0.1.db', help='Path to the DuckDB database file. Default is db/ctu-hornet-65-niner_v0.1.db.')
-    
+
     args = parser.parse_args()
+    checks = args.check or list(CHECKS)
 
     # Calculate the maximum payload size based on MTU and TCP/IP overhead
     max_payload = args.mtu - args.tcp_ip_overhead
-    
-    # Process the flows with the given parameters
-    process_flows(args.db, args.log_file, max_payload)
+
+    con = duckdb.connect(args.db, read_only=True)
+    violations = validate_flows(con, checks, max_payload, args.report)
+    flows, counts = violation_counts(con, checks, max_payload)
+    print(f"Checked {sum(flows.values())} flows of {len(flows)} sources, "
+          f"{violations} violations written to {args.report}:")
+    for check, source, count in counts:
+        print(f"  {check:<20} {str(source):<40} {count:>10} of {flows[source]} flows")
+    con.close()
 
 if __name__ == "__main__":
     main()
-    print("Processing completed. Check the log file for any errors found.")
-
@@ -2,7 +2,7 @@
 
 # Function to display usage information
 usage() {
-    echo "Usage: $0 -u UID_LIST_FILE -p PATH_TO_LOGS"
+    echo "Usage: $0 -u UID_LIST_FILE -p PATH_TO_LOGS [-b]"
     exit 1
 }
 
@@ -33,8 +33,15 @@ cleanup() {
         rm -f "$temp_file"
         log "Cleaned up temporary files"
     fi
+    if [ -n "$uid_patterns" ]; then
+        rm -f "$uid_patterns"
+    fi
 }
 
+# Function to rewrite a log file without the lines matching grep patterns,
+# and the compressor it uses
+source "$(dirname "$0")/rewrite_file.sh" || { echo "Failed to load $(dirname "$0")/rewrite_file.sh"; exit 1; }
+
 # Trap signals for cleanup
 trap cleanup EXIT INT TERM
 
@@ -45,7 +52,7 @@ if [[ "$(uname)" != "Linux" ]]; then
 fi
 
 # Parse command line arguments
-while getopts ":u:p:v" opt; do
+while getopts ":u:p:bv" opt; do
   case ${opt} in
     u )
       UID_LIST_FILE=$OPTARG
@@ -53,6 +60,9 @@ while getopts ":u:p:v" opt; do
     p )
       PATH_TO_LOGS=$OPTARG
       ;;
+    b )
+      BACKUP=1
+      ;;
     v )
       VERBOSE=1
       ;;
@@ -68,7 +78,7 @@ if [ -z "$UID_LIST_FILE" ] || [ -z "$PATH_TO_LOGS" ]; then
 fi
 
 # Check required commands
-for cmd in find zcat grep gzip mktemp mv cp; do
+for cmd in find zcat grep awk gzip mktemp mv ln chmod sync; do
     command_exists "$cmd"
 done
 
@@ -87,8 +97,10 @@ LOG_FILE="$LOG_DIR/process_logs_$(date '+%Y%m%d_%H%M%S').log"
 mkdir -p "$LOG_DIR" || { echo "Failed to create log directory"; exit 1; }
 touch "$LOG_FILE" || { echo "Failed to create log file"; exit 1; }
 
-# Read UIDs from file into an array
-readarray -t UIDs < "$UID_LIST_FILE"
+# Write the UIDs of the list file to a pattern file for grep, without the
+# empty lines, which would match every line
+uid_patterns=$(mktemp) || { echo "Failed to create temporary file"; exit 1; }
+grep -v '^[[:space:]]*$' "$UID_LIST_FILE" > "$uid_patterns"
 
 # Find and count the number of .gz files
 file_count=$(find "$PATH_TO_LOGS" -type f -name '*.gz' | wc -l)
@@ -102,39 +114,17 @@ if [[ "$confirm" != "y" && "$confirm" != "Y" ]]; then
     exit 0
 fi
 
-# Process each file for each UID
+# Process each file, removing all UIDs in one pass
 find "$PATH_TO_LOGS" -type f -name '*.gz' | while read -r file; do
-    # Create a backup of the original file
-    backup_file="${file}.bak"
-    cp "$file" "$backup_file" || { log "Failed to create backup for $file"; continue; }
-    log "Created backup for $file"
-
-    # Use a temporary file to store the filtered output
-    temp_file=$(mktemp) || { log "Failed to create temporary file"; continue; }
-
-    # Decompress the log file
-    zcat "$file" > "$temp_file"
-
-    # Remove each UID strictly
-    for uid in "${UIDs[@]}"; do
-        grep -v -F "$uid" "$temp_file" > "${temp_file}.filtered"
-        mv "${temp_file}.filtered" "$temp_file"
-    done
-
-    # Recompress the log file
-    gzip < "$temp_file" > "$file"
-
-    # Log the processing
-    log "Processed $file"
-
-    # Cleanup temporary file
-    rm -f "$temp_file"
+    rewrite_file "$file" -f "$uid_patterns"
 done
 
 # Cleanup: Optionally remove backup files after successful processing
-read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
-if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
-    find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
-    log "Backup files removed"
+if [ -n "$BACKUP" ]; then
+    read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
+    if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
+        find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
+        log "Backup files removed"
+    fi
 fi
 
@@ -0,0 +1,649 @@
+import os
+import re
+import sys
+import gzip
+import zlib
+import bisect
+import struct
+import duckdb
+import hashlib
+import shutil
+import socket
+import logging
+import argparse
+import ipaddress
+import tempfile
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Compression level of rewritten files, the default of the gzip command.
+COMPRESS_LEVEL = 6
+
+# Rewritten files are compressed in blocks of this many bytes on a pool of
+# threads, as pigz does, each block primed with the deflate window, the last
+# 32 KiB of the data before it.
+COMPRESS_BLOCK = 128 * 1024
+DEFLATE_WINDOW = 32 * 1024
+
+# Keys of the fields of a Zeek JSON log line the rules are matched against.
+# Quotes inside string values are escaped, so they only match the keys
+# themselves.
+UID_KEY = b'"uid"'
+IP_KEYS = (b'"id.orig_h"', b'"id.resp_h"')
+
+# The three fields in the order Zeek writes them, found in one search.
+CONN_FIELDS = re.compile(rb'"uid"\s*:\s*"([^"]*)".*?"id\.orig_h"\s*:\s*"([^"]*)".*?"id\.resp_h"\s*:\s*"([^"]*)"')
+
+# Maximum number of addresses whose match is remembered by a worker process.
+IP_CACHE_SIZE = 1 << 20
+
+# Number of bit positions of a key in the Bloom filters of the files, the
+# same as in ingestion/zeek_ingest_connlog_by_source.py.
+BLOOM_HASHES = 7
+
+# Networks with fewer addresses are probed in the Bloom filters address by
+# address, larger ones are only compared with the address range of a file.
+BLOOM_MAX_RANGE = 256
+
+# A Zeek UID, as opposed to an IP address or network.
+UID_RULE = re.compile(r'[A-Za-z0-9]+')
+
+# Rules to purge by, and threads compressing a rewritten file, set once in
+# every worker process.
+purge_rules = None
+compress_threads = 1
+
+# Whether the address rules match an address, for the addresses seen by the
+# worker process. Addresses repeat across the flows of a honeypot.
+ip_cache = {}
+
+
+def setup_logging(log_file):
+    """Set up logging to the specified log file."""
+    logging.basicConfig(filename=log_file, level=logging.INFO,
+                        format='%(asctime)s %(levelname)s:%(message)s')
+
+
+def read_uids(file_path):
+    """Read UIDs from a file, one per line, skipping empty lines."""
+    with open(file_path, 'r') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def merge_ranges(ranges):
+    """
+    Merge (start, end) ranges of addresses into sorted, disjoint ranges.
+    Return their starts and ends as two lists, for lookups with bisect.
+    """
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def read_rules(file_path):
+    """
+    Read purge rules from a file, one per line: a UID, an IPv4 or IPv6
+    address, or a network in CIDR notation such as 10.0.0.0/8 or 2001:db8::/32.
+    Empty lines and lines starting with # are skipped.
+
+    Return the UIDs, and the addresses and networks as (start, end) ranges of
+    integers per address family. Raise ValueError for a rule that is neither.
+    """
+    uids = set()
+    ranges = {4: [], 6: []}
+    with open(file_path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            rule = line.strip()
+            if not rule or rule.startswith('#'):
+                continue
+            if UID_RULE.fullmatch(rule):
+                uids.add(rule)
+                continue
+            try:
+                network = ipaddress.ip_network(rule, strict=False)
+            except ValueError:
+                raise ValueError(f'{file_path}:{number}: not a UID, IP address or network: {rule}')
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+    return uids, ranges
+
+
+def load_rules(rules_files=(), uid_files=()):
+    """
+    Return the rules of the rules files and the UIDs of the UID files: the
+    UIDs as a set, and the addresses and networks of each family merged into
+    an interval index of sorted, disjoint ranges.
+    """
+    uids = set()
+    ranges = {4: [], 6: []}
+    for file_path in rules_files:
+        file_uids, file_ranges = read_rules(file_path)
+        uids |= file_uids
+        for family in ranges:
+            ranges[family] += file_ranges[family]
+    for file_path in uid_files:
+        uids |= read_uids(file_path)
+    rules = {family: merge_ranges(family_ranges) for family, family_ranges in ranges.items()}
+    # Lines are matched as bytes, without decoding them
+    rules['uids'] = {uid.encode() for uid in uids}
+    rules['networks'] = sum(len(family_ranges) for family_ranges in ranges.values())
+    return rules
+
+
+def find_log_files(log_dir):
+    """Return the .gz files under log_dir, sorted."""
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(log_dir)
+                  for name in names if name.endswith('.gz'))
+
+
+def field_value(line, key):
+    """
+    Return the value of a string field without quotes or escapes, like uid
+    or an address, of a JSON log line, as bytes, or None if it has none.
+    """
+    idx = line.find(key)
+    if idx < 0:
+        return None
+    idx += len(key)
+    start = line.find(b'"', idx)
+    if start < 0 or line[idx:start].strip() != b':':
+        return None
+    end = line.find(b'"', start + 1)
+    return line[start + 1:end] if end >= 0 else None
+
+
+def ip_value(text):
+    """Return the address family and integer value of an IP address, or None if it is not one."""
+    try:
+        text = text.decode()
+        if ':' in text:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def in_ranges(ranges, value):
+    """Check whether a value falls in one of the sorted, disjoint ranges."""
+    starts, ends = ranges
+    idx = bisect.bisect_right(starts, value) - 1
+    return idx >= 0 and value <= ends[idx]
+
+
+def line_fields(line):
+    """Return the uid, id.orig_h and id.resp_h of a JSON log line, as bytes, None for those it does not have."""
+    match = CONN_FIELDS.search(line)
+    if match:
+        return match.groups()
+    return (field_value(line, UID_KEY),) + tuple(field_value(line, key) for key in IP_KEYS)
+
+
+def ip_purged(text):
+    """Check whether an address, as bytes, is matched by the address rules."""
+    purged = ip_cache.get(text)
+    if purged is None:
+        value = ip_value(text)
+        purged = value is not None and in_ranges(purge_rules[value[0]], value[1])
+        if len(ip_cache) >= IP_CACHE_SIZE:
+            ip_cache.clear()
+        ip_cache[text] = purged
+    return purged
+
+
+def match_line(line):
+    """
+    Return what a log line is purged by: ('uid', uid) if its uid is in the
+    rules, ('ip', None) if its origin or responder address is, or None.
+    """
+    if not purge_rules['networks']:
+        uid = field_value(line, UID_KEY)
+        return ('uid', uid) if uid is not None and uid in purge_rules['uids'] else None
+    uid, orig_h, resp_h = line_fields(line)
+    if uid is not None and uid in purge_rules['uids']:
+        return 'uid', uid
+    for text in (orig_h, resp_h):
+        if text is not None and ip_purged(text):
+            return 'ip', None
+    return None
+
+
+def init_worker(rules, threads=1):
+    """Keep the rules in the worker process, so they are sent once instead of with every file."""
+    global purge_rules, compress_threads
+    purge_rules = rules
+    compress_threads = threads
+
+
+def deflate_block(data, dictionary, final):
+    """
+    Deflate a block of a gzip member, given the data before it as the
+    dictionary. The block ends on a byte boundary, so blocks compressed
+    separately are concatenated into one deflate stream, ended by the final one.
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    """
+    Write a gzip file compressed in blocks on a pool of threads, like pigz.
+
+    The result is a single regular gzip member, about the size of the output
+    of gzip at the same level. zlib releases the GIL while compressing, so a
+    file is compressed on as many cores as threads. At most two blocks per
+    thread are held in memory.
+    """
+
+    def __init__(self, raw, threads=1):
+        self.raw = raw
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.max_pending = 2 * threads
+        self.buffer = []
+        self.buffered = 0
+        self.window = b''
+        self.crc = 0
+        self.size = 0
+        # Header of a gzip member without file name or modification time
+        raw.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= COMPRESS_BLOCK:
+            self.submit(final=False)
+
+    def submit(self, final):
+        """Hand the buffered data over to the pool as the next block, writing out the blocks already compressed."""
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append(self.executor.submit(deflate_block, data, self.window, final))
+        self.window = (self.window + data)[-DEFLATE_WINDOW:]
+        while len(self.pending) > (0 if final else self.max_pending):
+            self.raw.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress the last block and write the gzip trailer. The raw file is left open."""
+        self.submit(final=True)
+        self.raw.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        self.executor.shutdown()
+
+    def abort(self):
+        """Stop compressing without writing the rest of the file."""
+        self.executor.shutdown(cancel_futures=True)
+
+
+def open_rewrite(file_path):
+    """
+    Open a temporary gzip file in the folder of file_path to write its
+    filtered lines to. Return its path, the raw file and the gzip writer.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                    prefix='.' + os.path.basename(file_path), suffix='.tmp')
+    raw = os.fdopen(fd, 'wb')
+    return tmp_path, raw, ParallelGzipWriter(raw, compress_threads)
+
+
+def replace_file(tmp_path, file_path, backup=False):
+    """
+    Atomically replace file_path with tmp_path, in the same folder, and sync
+    the folder so the rename survives a crash. With backup, the original is
+    kept as file_path.bak, a hard link to it instead of a copy, unless an
+    older backup exists.
+    """
+    shutil.copymode(file_path, tmp_path)
+    if backup and not os.path.exists(file_path + '.bak'):
+        os.link(file_path, file_path + '.bak')
+    os.replace(tmp_path, file_path)
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_prefix(file_path, dst, count):
+    """Copy the first count lines of a gzipped file to dst."""
+    with gzip.open(file_path, 'rb') as src:
+        for _, line in zip(range(count), src):
+            dst.write(line)
+
+
+def purge_file(file_path, dry_run=False, backup=False):
+    """
+    Remove the lines matching purge_rules from a gzipped log file, all rules
+    in one streaming pass.
+
+    Files without purged lines are only read. At the first purged line, the
+    lines before it are copied to a temporary file in the same folder, and
+    the lines kept after it are written as they are read, compressed in
+    parallel. The temporary file replaces the original once it is complete
+    and synced to disk, so an interrupted purge leaves the original file
+    untouched and never needs more extra space than the rewritten file.
+
+    Return the path, the number of lines read, removed and removed by an
+    address rule, and the UIDs found.
+    """
+    lines = 0
+    removed = 0
+    by_ip = 0
+    found = set()
+    tmp_path = raw = dst = None
+    try:
+        with gzip.open(file_path, 'rb') as src:
+            for line in src:
+                lines += 1
+                match = match_line(line)
+                if match is not None:
+                    removed += 1
+                    if match[0] == 'uid':
+                        found.add(match[1])
+                    else:
+                        by_ip += 1
+                    if dst is None and not dry_run:
+                        tmp_path, raw, dst = open_rewrite(file_path)
+                        copy_prefix(file_path, dst, lines - 1)
+                elif dst is not None:
+                    dst.write(line)
+        if dst is not None:
+            dst.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+            raw.close()
+            replace_file(tmp_path, file_path, backup)
+    finally:
+        if dst is not None:
+            dst.abort()
+        if raw is not None and not raw.closed:
+            raw.close()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return file_path, lines, removed, by_ip, found
+
+
+def file_sha256(file_path):
+    """Return the SHA-256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def indexed_files(con, files):
+    """
+    Return the files covered by the location index of the database, those
+    ingested since the index exists and unchanged since, as a dict of their
+    file_id to their path.
+    """
+    if not con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'uid_locations'").fetchone()[0]:
+        return {}
+    manifest = {path: (file_id, size, mtime) for path, file_id, size, mtime in con.execute(
+        'SELECT path, file_id, size, mtime FROM ingest_manifest WHERE file_id IS NOT NULL').fetchall()}
+    indexed = {}
+    for file_path in files:
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        if path in manifest and manifest[path][1:] == (stat.st_size, stat.st_mtime):
+            indexed[manifest[path][0]] = file_path
+    return indexed
+
+
+def bloom_hashes(key):
+    """Return the two hashes the bit positions of a key in a Bloom filter are derived from."""
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+def address_key(family, value):
+    """Return the Bloom filter key of an IP address of a family, given as an integer."""
+    return bytes([family]) + value.to_bytes(4 if family == 4 else 16, 'big')
+
+
+def in_bloom(bloom, hashes):
+    """Check whether the key of the given bloom_hashes may be in a Bloom filter."""
+    bits = len(bloom) * 8
+    h1, h2 = hashes
+    for i in range(BLOOM_HASHES):
+        position = (h1 + i * h2) % bits
+        if not bloom[position >> 3] & (1 << (position & 7)):
+            return False
+    return True
+
+
+def filter_keys(rules):
+    """
+    Return the keys the Bloom filters are probed with for the rules: the
+    bloom_hashes of every UID, and per address family the address ranges,
+    with the bloom_hashes of every address of the ranges small enough to be
+    probed address by address, None for the others.
+    """
+    uids = [(uid, bloom_hashes(b'u' + uid)) for uid in rules['uids']]
+    ranges = {}
+    for family in (4, 6):
+        ranges[family] = [(start, end, [bloom_hashes(address_key(family, value)) for value in range(start, end + 1)]
+                           if end - start < BLOOM_MAX_RANGE else None)
+                          for start, end in zip(*rules[family])]
+    return uids, ranges
+
+
+def filter_match(file_filter, uids, ranges):
+    """
+    Check whether a file may contain lines matching the rules, according to
+    its filter: the minimum and maximum of its uids and of its addresses of
+    each family, and the Bloom filter of all of them.
+    """
+    uid_min, uid_max, ip4_min, ip4_max, ip6_min, ip6_max, bloom = file_filter
+    if uid_min is not None:
+        uid_min, uid_max = uid_min.encode(), uid_max.encode()
+        if any(uid_min <= uid <= uid_max and in_bloom(bloom, hashes) for uid, hashes in uids):
+            return True
+    for family, low, high in ((4, ip4_min, ip4_max), (6, ip6_min, ip6_max)):
+        if low is None:
+            continue
+        for start, end, hashes in ranges[family]:
+            if start > high or end < low:
+                continue
+            if hashes is None or any(in_bloom(bloom, value_hashes) for value_hashes in hashes):
+                return True
+    return False
+
+
+def filter_files(con, indexed, rules):
+    """
+    Return the file_id of the indexed files whose filters, kept by the
+    ingester next to the location index, may match the rules. Files without
+    a filter are kept.
+    """
+    if not con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'file_filters'").fetchone()[0]:
+        return list(indexed)
+    uids, ranges = filter_keys(rules)
+    filters = {file_filter[0]: file_filter[1:] for file_filter in con.execute('''
+        SELECT file_id, uid_min, uid_max, ip4_min, ip4_max, ip6_min, ip6_max, bloom FROM file_filters
+    ''').fetchall()}
+    return [file_id for file_id in indexed
+            if file_id not in filters or filter_match(filters[file_id], uids, ranges)]
+
+
+def locate_files(con, files, rules):
+    """
+    Return the files that may contain lines matching the rules, looked up in
+    the location index kept by the ingester (see
+    ingestion/zeek_ingest_connlog_by_source.py), the file_id of the indexed
+    ones among them, and the number of files skipped by their filters alone.
+    Files the index does not cover are always returned, any of their lines
+    may match.
+
+    The filters of the files are checked first, and only the entries of the
+    files they keep are looked up in the index.
+
+    The UIDs of the rules and the indexed addresses they match are left in
+    the purge_uids and purge_ips temporary tables.
+    """
+    init_worker(rules)
+    indexed = indexed_files(con, files)
+    if not indexed:
+        return files, {}, 0
+    filtered = filter_files(con, indexed, rules)
+    addresses = []
+    if rules['networks']:
+        addresses = [ip for ip, in con.execute(
+            'SELECT DISTINCT ip FROM ip_locations WHERE list_contains(?::INTEGER[], file_id)', (filtered,)
+        ).fetchall() if ip_purged(ip.encode())]
+    con.execute('CREATE OR REPLACE TEMP TABLE purge_uids AS SELECT unnest(?::VARCHAR[]) AS uid',
+                ([uid.decode() for uid in rules['uids']],))
+    con.execute('CREATE OR REPLACE TEMP TABLE purge_ips AS SELECT unnest(?::VARCHAR[]) AS ip', (addresses,))
+    located = con.execute('''
+        SELECT file_id FROM (
+            SELECT file_id FROM uid_locations SEMI JOIN purge_uids USING (uid)
+            UNION
+            SELECT file_id FROM ip_locations SEMI JOIN purge_ips USING (ip)
+        ) WHERE list_contains(?::INTEGER[], file_id)
+    ''', (filtered,)).fetchall()
+    file_ids = {indexed[file_id]: file_id for file_id, in located}
+    unindexed = set(files) - set(indexed.values())
+    return sorted(unindexed | set(file_ids)), file_ids, len(indexed) - len(filtered)
+
+
+def update_index(con, changed, file_ids):
+    """
+    Bring the location index up to date with the purged files: record the
+    size, modification time and hash of the indexed files that changed, and
+    drop the UIDs and addresses purged from them.
+    """
+    changed = [file_path for file_path in changed if file_path in file_ids]
+    if not changed:
+        return
+    ids = [file_ids[file_path] for file_path in changed]
+    con.execute('BEGIN TRANSACTION')
+    for file_path in changed:
+        stat = os.stat(file_path)
+        con.execute('UPDATE ingest_manifest SET size = ?, mtime = ?, sha256 = ? WHERE file_id = ?',
+                    (stat.st_size, stat.st_mtime, file_sha256(file_path), file_ids[file_path]))
+    for table, column, purged in (('uid_locations', 'uid', 'purge_uids'), ('ip_locations', 'ip', 'purge_ips')):
+        con.execute(f'''
+            DELETE FROM {table} USING {purged}
+            WHERE {table}.{column} = {purged}.{column} AND list_contains(?::INTEGER[], {table}.file_id)
+        ''', (ids,))
+    con.execute('COMMIT')
+
+
+def purge_files(files, rules, workers=None, dry_run=False, backup=False, threads=None):
+    """
+    Purge the lines matching the rules (see load_rules) from the files on a
+    pool of worker processes, one file per task, each compressing the files
+    it rewrites on threads threads. By default the CPUs are shared among the
+    files processed at the same time. Return the number of lines removed and
+    removed by an address rule, the files changed, the UIDs found and the
+    files that could not be read.
+    """
+    cpus = os.cpu_count() or 1
+    workers = workers or cpus
+    threads = threads or max(1, cpus // max(1, min(workers, len(files))))
+    total_removed = 0
+    total_by_ip = 0
+    changed = []
+    found = set()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(rules, threads)) as executor:
+        futures = {executor.submit(purge_file, file_path, dry_run, backup): file_path for file_path in files}
+        for future in as_completed(futures):
+            try:
+                file_path, lines, removed, by_ip, file_found = future.result()
+            except (OSError, EOFError, zlib.error) as e:
+                logging.error(f'Error processing file: {futures[future]}. Error: {e}')
+                failed.append(futures[future])
+                continue
+            if removed:
+                changed.append(file_path)
+                logging.info(f'{"Would remove" if dry_run else "Removed"} {removed} of {lines} lines from {file_path}')
+            total_removed += removed
+            total_by_ip += by_ip
+            found |= file_found
+    return total_removed, total_by_ip, changed, found, failed
+
+
+def main():
+    """Main function to parse arguments and execute the purge."""
+    parser = argparse.ArgumentParser(
+        description="Delete Zeek log lines by UID, IP address or network from gzipped log files.")
+    parser.add_argument('--log_dir', required=True, help='Folder of .gz log files, searched recursively')
+    parser.add_argument('--db_name',
+                        help='Database the files were ingested into, only the files its location index '
+                             'lists for the rules are read')
+    parser.add_argument('--rules_file', action='append', default=[],
+                        help='File of rules, one UID, IP address or CIDR network per line (can be repeated)')
+    parser.add_argument('--uid_file', action='append', default=[],
+                        help='File containing UIDs to delete, one per line (can be repeated)')
+    parser.add_argument('--workers', type=int, help='Number of files processed in parallel (default: number of CPUs)')
+    parser.add_argument('--compress_threads', type=int,
+                        help='Number of threads compressing each rewritten file (default: the CPUs shared '
+                             'among the files processed in parallel)')
+    parser.add_argument('--backup', action='store_true',
+                        help='Keep the original of every rewritten file as <file>.bak, a hard link instead of a copy')
+    parser.add_argument('--dry_run', action='store_true', help='Count the lines that would be removed without changing files')
+    parser.add_argument('--log_file', default='purge.log', help='Log file name (default: purge.log)')
+    parser.add_argument('--confirm', action='store_true', help='Ask for confirmation before changing files')
+
+    args = parser.parse_args()
+    if not args.rules_file and not args.uid_file:
+        parser.error('give at least one --rules_file or --uid_file')
+
+    setup_logging(args.log_file)
+
+    try:
+        rules = load_rules(args.rules_file, args.uid_file)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    uids = rules['uids']
+    files = find_log_files(args.log_dir)
+    print(f"Found {len(files)} .gz files in {args.log_dir}.")
+    con = file_ids = None
+    candidates = files
+    if args.db_name:
+        con = duckdb.connect(args.db_name, read_only=args.dry_run)
+        candidates, file_ids, filtered = locate_files(con, files, rules)
+        stats = (f"{filtered} files skipped by their filters and {len(files) - len(candidates) - filtered} "
+                 f"by the location index of {args.db_name}, {len(candidates)} to read.")
+        logging.info(stats)
+        print(stats)
+    rule_summary = f"{len(uids)} UIDs and {rules['networks']} IP addresses or networks"
+
+    if args.confirm and not args.dry_run:
+        confirmation = input(f"Are you sure you want to remove the lines of {rule_summary} from these files? [y/N]: ")
+        if confirmation.lower() != 'y':
+            print("Purge aborted.")
+            sys.exit(0)
+
+    start_time = datetime.now()
+    logging.info(f"Purge of {rule_summary} from {len(candidates)} of {len(files)} files started at {start_time}")
+
+    removed, by_ip, changed, found, failed = purge_files(candidates, rules, args.workers, args.dry_run,
+                                                         args.backup, args.compress_threads)
+    if con is not None:
+        if not args.dry_run:
+            update_index(con, changed, file_ids)
+        con.close()
+
+    end_time = datetime.now()
+    action = 'Would remove' if args.dry_run else 'Removed'
+    report = (f"{action} {removed} lines from {len(changed)} of {len(files)} files "
+              f"({removed - by_ip} by UID, {by_ip} by IP address), "
+              f"{len(uids) - len(found)} of {len(uids)} UIDs not found, in {end_time - start_time}")
+    if failed:
+        report += f". {len(failed)} files could not be read, see {args.log_file}"
+    logging.info(report)
+    print(report)
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 
 # Function to display usage information
 usage() {
-    echo "Usage: $0 -i IP_TO_REMOVE -p PATH_TO_LOGS"
+    echo "Usage: $0 -i IP_TO_REMOVE -p PATH_TO_LOGS [-b]"
     exit 1
 }
 
@@ -57,6 +57,10 @@ cleanup() {
     fi
 }
 
+# Function to rewrite a log file without the lines matching grep patterns,
+# and the compressor it uses
+source "$(dirname "$0")/rewrite_file.sh" || { echo "Failed to load $(dirname "$0")/rewrite_file.sh"; exit 1; }
+
 # Trap signals for cleanup
 trap cleanup EXIT INT TERM
 
@@ -67,7 +71,7 @@ if [[ "$(uname)" != "Linux" ]]; then
 fi
 
 # Parse command line arguments
-while getopts ":i:p:v" opt; do
+while getopts ":i:p:bv" opt; do
   case ${opt} in
     i )
       IP_TO_REMOVE=$OPTARG
@@ -75,6 +79,9 @@ while getopts ":i:p:v" opt; do
     p )
       PATH_TO_LOGS=$OPTARG
       ;;
+    b )
+      BACKUP=1
+      ;;
     v )
       VERBOSE=1
       ;;
@@ -93,7 +100,7 @@ fi
 validate_ip "$IP_TO_REMOVE"
 
 # Check required commands
-for cmd in find zcat grep gzip mktemp mv cp; do
+for cmd in find zcat grep awk gzip mktemp mv ln chmod sync; do
     command_exists "$cmd"
 done
 
@@ -120,29 +127,15 @@ fi
 
 # Process each file
 find "$PATH_TO_LOGS" -type f -name '*.gz' | while read -r file; do
-    # Create a backup of the original file
-    backup_file="${file}.bak"
-    cp "$file" "$backup_file" || { log "Failed to create backup for $file"; continue; }
-    log "Created backup for $file"
-
-    # Use a temporary file to store the filtered output
-    temp_file=$(mktemp) || { log "Failed to create temporary file"; continue; }
-
-    # Decompress, filter, and recompress the log file
-    if zcat "$file" | grep -v -F "$IP_TO_REMOVE" | gzip > "$temp_file"; then
-        # Replace the original file with the filtered one
-        mv "$temp_file" "$file" || { log "Failed to replace original file $file"; rm -f "$temp_file"; continue; }
-        log "Processed $file"
-    else
-        log "Error processing $file"
-        rm -f "$temp_file"
-    fi
+    rewrite_file "$file" -e "$IP_TO_REMOVE"
 done
 
 # Cleanup: Optionally remove backup files after successful processing
-read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
-if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
-    find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
-    log "Backup files removed"
+if [ -n "$BACKUP" ]; then
+    read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
+    if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
+        find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
+        log "Backup files removed"
+    fi
 fi
 
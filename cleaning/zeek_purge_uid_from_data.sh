@@ -2,7 +2,7 @@
 
 # Function to display usage information
 usage() {
-    echo "Usage: $0 -u UID_TO_REMOVE -p PATH_TO_LOGS"
+    echo "Usage: $0 -u UID_TO_REMOVE -p PATH_TO_LOGS [-b]"
     exit 1
 }
 
@@ -35,6 +35,10 @@ cleanup() {
     fi
 }
 
+# Function to rewrite a log file without the lines matching grep patterns,
+# and the compressor it uses
+source "$(dirname "$0")/rewrite_file.sh" || { echo "Failed to load $(dirname "$0")/rewrite_file.sh"; exit 1; }
+
 # Trap signals for cleanup
 trap cleanup EXIT INT TERM
 
@@ -45,7 +49,7 @@ if [[ "$(uname)" != "Linux" ]]; then
 fi
 
 # Parse command line arguments
-while getopts ":u:p:v" opt; do
+while getopts ":u:p:bv" opt; do
   case ${opt} in
     u )
       UID_TO_REMOVE=$OPTARG
@@ -53,6 +57,9 @@ while getopts ":u:p:v" opt; do
     p )
       PATH_TO_LOGS=$OPTARG
       ;;
+    b )
+      BACKUP=1
+      ;;
     v )
       VERBOSE=1
       ;;
@@ -68,7 +75,7 @@ if [ -z "$UID_TO_REMOVE" ] || [ -z "$PATH_TO_LOGS" ]; then
 fi
 
 # Check required commands
-for cmd in find zcat grep gzip mktemp mv cp; do
+for cmd in find zcat grep awk gzip mktemp mv ln chmod sync; do
     command_exists "$cmd"
 done
 
@@ -95,29 +102,15 @@ fi
 
 # Process each file
 find "$PATH_TO_LOGS" -type f -name '*.gz' | while read -r file; do
-    # Create a backup of the original file
-    backup_file="${file}.bak"
-    cp "$file" "$backup_file" || { log "Failed to create backup for $file"; continue; }
-    log "Created backup for $file"
-
-    # Use a temporary file to store the filtered output
-    temp_file=$(mktemp) || { log "Failed to create temporary file"; continue; }
-
-    # Decompress, filter, and recompress the log file
-    if zcat "$file" | grep -v -F "$UID_TO_REMOVE" | gzip > "$temp_file"; then
-        # Replace the original file with the filtered one
-        mv "$temp_file" "$file" || { log "Failed to replace original file $file"; rm -f "$temp_file"; continue; }
-        log "Processed $file"
-    else
-        log "Error processing $file"
-        rm -f "$temp_file"
-    fi
+    rewrite_file "$file" -e "$UID_TO_REMOVE"
 done
 
 # Cleanup: Optionally remove backup files after successful processing
-read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
-if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
-    find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
-    log "Backup files removed"
+if [ -n "$BACKUP" ]; then
+    read -p "Do you want to remove the backup files? (y/n): " remove_backup_files
+    if [[ "$remove_backup_files" == "y" || "$remove_backup_files" == "Y" ]]; then
+        find "$PATH_TO_LOGS" -type f -name '*.gz.bak' -exec rm -f {} \;
+        log "Backup files removed"
+    fi
 fi
 
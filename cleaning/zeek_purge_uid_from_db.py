@@ -9,23 +9,86 @@ def setup_logging(log_file):
     logging.basicConfig(filename=log_file, level=logging.INFO,
                         format='%(asctime)s %(levelname)s:%(message)s')
 
-def read_uids(file_path):
-    """Read UIDs from a file, one per line."""
-    with open(file_path, 'r') as f:
-        uids = [line.strip() for line in f.readlines()]
-    return uids
-
-def delete_entries(con, uids):
-    """Delete log entries matching the given UIDs and return total rows deleted."""
-    total_deleted = 0
-    for uid in uids:
-        affected_rows = con.execute("DELETE FROM logs WHERE uid = ?", (uid,)).rowcount
-        total_deleted += affected_rows
-        if affected_rows == 0:
-            logging.warning(f"No entries found for UID: {uid}")
-        else:
-            logging.info(f"Deleted {affected_rows} entries with UID: {uid}")
-    return total_deleted
+def load_uids(con, file_path):
+    """
+    Load the UIDs of a file, one per line, into the purge_uids temporary
+    table with DuckDB's CSV reader. Return the number of distinct UIDs.
+    """
+    con.execute('''
+        CREATE OR REPLACE TEMP TABLE purge_uids AS
+        SELECT DISTINCT trim(uid) AS uid
+        FROM read_csv(?, columns = {'uid': 'VARCHAR'}, header = false, delim = '\t', quote = '', escape = '',
+                      strict_mode = false)
+        WHERE trim(uid) <> ''
+    ''', (file_path,))
+    return con.execute('SELECT COUNT(*) FROM purge_uids').fetchone()[0]
+
+def logs_table(con):
+    """Return the table holding the log entries, logs_v2 in databases converted to the v2 layout."""
+    v2 = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_v2'").fetchone()[0]
+    return 'logs_v2' if v2 else 'logs'
+
+def has_staging(con):
+    """Check whether the database has rows staged by a deferred ingest, not merged into logs yet."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_staging'").fetchone()[0] > 0
+
+def has_rollups(con):
+    """Check whether the database has metrics rollups to keep up to date."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'rollup_dirty'").fetchone()[0] > 0
+
+def bump_generation(con):
+    """Invalidate the results of metrics/duckdb_metrics.py cached for the current logs."""
+    if con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_generation'").fetchone()[0]:
+        con.execute("UPDATE logs_generation SET generation = generation + 1")
+
+def match_entries(con):
+    """
+    Join the log entries, including the staged ones, with purge_uids into
+    the purge_matches temporary table, with the number of entries and time
+    range of each UID and source. Return the number of UIDs found and of
+    entries matching them.
+    """
+    entries = 'SELECT uid, source, ts FROM logs'
+    if has_staging(con):
+        entries += ' UNION ALL SELECT uid, source, ts FROM logs_staging'
+    con.execute(f'''
+        CREATE OR REPLACE TEMP TABLE purge_matches AS
+        SELECT uid, source, COUNT(*) AS entries, MIN(ts) AS ts_min, MAX(ts) AS ts_max
+        FROM ({entries}) SEMI JOIN purge_uids USING (uid)
+        GROUP BY uid, source
+    ''')
+    return con.execute('SELECT COUNT(DISTINCT uid), COALESCE(SUM(entries), 0) FROM purge_matches').fetchone()
+
+def log_missing_uids(con):
+    """Write the UIDs of purge_uids without log entries to the log file."""
+    for uid, in con.execute('SELECT uid FROM purge_uids ANTI JOIN purge_matches USING (uid) ORDER BY uid').fetchall():
+        logging.warning(f"No entries found for UID: {uid}")
+
+def delete_entries(con):
+    """
+    Delete the log entries matching the UIDs of purge_uids in one set-based
+    DELETE, in a single transaction together with the bookkeeping of the
+    metrics. The rows staged by a deferred ingest are deleted too, or the
+    next merge would bring them back. Return the number of UIDs found and of
+    rows deleted.
+    """
+    tables = [logs_table(con)] + (['logs_staging'] if has_staging(con) else [])
+    con.execute('BEGIN TRANSACTION')
+    try:
+        found, _ = match_entries(con)
+        deleted = sum(con.execute(f'''
+            DELETE FROM {table} USING purge_uids WHERE {table}.uid = purge_uids.uid
+        ''').fetchone()[0] for table in tables)
+        if deleted:
+            if has_rollups(con):
+                # Recompute the rollups of the hours of the deleted flows
+                con.execute('INSERT INTO rollup_dirty SELECT source, ts_min, ts_max FROM purge_matches')
+            bump_generation(con)
+        con.execute('COMMIT')
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+    return found, deleted
 
 def main():
     """Main function to parse arguments and execute the deletion."""
@@ -34,31 +97,41 @@ def main():
     parser.add_argument('--uid_file', required=True, help='File containing UIDs to delete, one per line')
     parser.add_argument('--log_file', default='deletion.log', help='Log file name (default: deletion.log)')
     parser.add_argument('--confirm', action='store_true', help='Ask for confirmation before deleting')
+    parser.add_argument('--dry_run', action='store_true', help='Count the entries that would be deleted without deleting them')
 
     args = parser.parse_args()
 
     setup_logging(args.log_file)
 
-    uids = read_uids(args.uid_file)
+    con = duckdb.connect(args.db_name)
+    total_uids = load_uids(con, args.uid_file)
 
-    if args.confirm:
-        confirmation = input(f"Are you sure you want to delete {len(uids)} entries? [y/N]: ")
+    if args.confirm or args.dry_run:
+        found, entries = match_entries(con)
+        print(f"{entries} entries match {found} of {total_uids} UIDs, {total_uids - found} UIDs not found.")
+        if args.dry_run:
+            log_missing_uids(con)
+            con.close()
+            return
+        confirmation = input(f"Are you sure you want to delete {entries} entries? [y/N]: ")
         if confirmation.lower() != 'y':
             print("Deletion aborted.")
+            con.close()
             sys.exit(0)
 
     start_time = datetime.now()
     logging.info(f"Deletion process started at {start_time}")
 
-    con = duckdb.connect(args.db_name)
-    total_deleted = delete_entries(con, uids)
+    found, total_deleted = delete_entries(con)
+    log_missing_uids(con)
     con.close()
 
     end_time = datetime.now()
+    report = f"Deleted {total_deleted} entries of {found} UIDs, {total_uids - found} of {total_uids} UIDs not found."
     logging.info(f"Deletion process completed at {end_time}")
-    logging.info(f"Total rows deleted: {total_deleted}")
+    logging.info(report)
     logging.info(f"Total time taken: {end_time - start_time}")
+    print(report)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,101 @@
+import os
+import duckdb
+import argparse
+import logging
+
+from zeek_ingest_connlog_by_source import setup_logging
+
+# Parquet compression codecs DuckDB can write.
+COMPRESSIONS = ['zstd', 'snappy', 'gzip', 'lz4', 'uncompressed']
+
+# Rows per Parquet row group, the unit readers skip with the min/max
+# statistics and read in parallel. The same size as a DuckDB row group.
+ROW_GROUP_SIZE = 122880
+
+# Day of a ts in seconds since the epoch, as a UTC DATE.
+EXPORT_DAY = "(DATE '1970-01-01' + CAST(floor(ts / 86400) AS INTEGER))"
+
+
+def export_logs(con, output_dir, compression='zstd', row_group_size=ROW_GROUP_SIZE, overwrite=False):
+    """
+    Write the flows of logs to output_dir as Parquet files partitioned by
+    source and UTC day, in source=<source>/date=<day>/ folders, sorted by time
+    within each file. Return the number of rows written.
+    """
+    options = ['FORMAT parquet', 'PARTITION_BY (source, date)', f'COMPRESSION {compression}',
+               f'ROW_GROUP_SIZE {row_group_size}']
+    if overwrite:
+        options.append('OVERWRITE true')
+    return con.execute(f'''
+        COPY (SELECT *, {EXPORT_DAY} AS date FROM logs ORDER BY source, ts)
+        TO '{output_dir}' ({", ".join(options)})
+    ''').fetchone()[0]
+
+
+def export_summary(output_dir):
+    """Return the number of partitions and files and the total size in bytes of the files under output_dir."""
+    partitions = files = size = 0
+    for root, _, names in os.walk(output_dir):
+        parquet = [name for name in names if name.endswith('.parquet')]
+        if parquet:
+            partitions += 1
+            files += len(parquet)
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in parquet)
+    return partitions, files, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the logs of a conn.log database as Parquet files partitioned by source and day.')
+    parser.add_argument('--db_name',
+                        required=True,
+                        help='DuckDB database to export')
+    parser.add_argument('--output_dir',
+                        required=True,
+                        help='Folder the source=<source>/date=<day>/ partitions are written to')
+    parser.add_argument('--compression',
+                        choices=COMPRESSIONS,
+                        default='zstd',
+                        help='Compression of the Parquet files (default: zstd)')
+    parser.add_argument('--row_group_size',
+                        type=int,
+                        default=ROW_GROUP_SIZE,
+                        help=f'Number of rows per Parquet row group (default: {ROW_GROUP_SIZE})')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='Replace the contents of --output_dir if it is not empty')
+    parser.add_argument('--log_file',
+                        default='export.log',
+                        help='Log file name (default: export.log)')
+    parser.add_argument('--log_level',
+                        default='INFO',
+                        help='Logging level (default: INFO)')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log_level.upper(), logging.INFO)
+    setup_logging(args.log_file, log_level)
+
+    if os.path.isdir(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite:
+        print(f'{args.output_dir} is not empty, pass --overwrite to replace its contents.')
+        return
+
+    con = duckdb.connect(args.db_name, read_only=True)
+    staged = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_staging'").fetchone()[0]
+    if staged:
+        print(f'{args.db_name} has rows waiting in logs_staging, finish the import with '
+              'zeek_ingest_connlog_by_source.py --deferred_dedupe first.')
+        return
+
+    logging.info(f'Exporting {args.db_name} to {args.output_dir}.')
+    rows = export_logs(con, args.output_dir, args.compression, args.row_group_size, args.overwrite)
+    con.close()
+
+    partitions, files, size = export_summary(args.output_dir)
+    report = (f'Exported {rows} rows to {files} Parquet files in {partitions} partitions, '
+              f'{size / 2**20:.1f} MiB.')
+    logging.info(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import os
+import duckdb
+import argparse
+import logging
+
+from zeek_ingest_connlog_by_source import setup_logging, schema_version, create_v2_table, v2_select_sql
+
+
+def copy_tables(con):
+    """Copy every table of the old database except logs into the new one."""
+    tables = con.execute('''
+        SELECT table_name, sql FROM duckdb_tables()
+        WHERE database_name = 'old' AND schema_name = 'main' AND table_name <> 'logs'
+    ''').fetchall()
+    for table, sql in tables:
+        con.execute(sql)
+        con.execute(f'INSERT INTO {table} SELECT * FROM old.main.{table}')
+        logging.info(f'Copied table {table}.')
+
+
+def migrate(con):
+    """Fill the v2 logs_v2 table of the new database from the logs of the old one."""
+    sources = [source for source, in con.execute(
+        'SELECT DISTINCT source FROM old.main.logs WHERE source IS NOT NULL').fetchall()]
+    create_v2_table(con, sources)
+    con.execute(f'INSERT INTO logs_v2 SELECT {v2_select_sql()} FROM old.main.logs ORDER BY rowid')
+
+    old_rows, old_hosts = con.execute('''
+        SELECT COUNT(*), COUNT(id_orig_h) + COUNT(id_resp_h) FROM old.main.logs
+    ''').fetchone()
+    new_rows, new_hosts = con.execute('''
+        SELECT COUNT(*), COUNT(COALESCE(orig_h4, orig_h6)) + COUNT(COALESCE(resp_h4, resp_h6)) FROM logs_v2
+    ''').fetchone()
+    if new_rows != old_rows:
+        raise ValueError(f'logs_v2 has {new_rows} rows, logs has {old_rows}')
+    if new_hosts != old_hosts:
+        raise ValueError(f'{old_hosts - new_hosts} IP addresses in logs could not be converted')
+    return new_rows
+
+
+def verify(con):
+    """Check that the logs view returns exactly the rows of the old logs table."""
+    # Databases created before ip_family existed do not have the column
+    columns = ', '.join(column for column, in con.execute('''
+        SELECT column_name FROM duckdb_columns()
+        WHERE database_name = 'old' AND table_name = 'logs' ORDER BY column_index
+    ''').fetchall())
+    for left, right in (('logs', 'old.main.logs'), ('old.main.logs', 'logs')):
+        diff = con.execute(f'''
+            SELECT COUNT(*) FROM (SELECT {columns} FROM {left} EXCEPT ALL SELECT {columns} FROM {right})
+        ''').fetchone()[0]
+        if diff:
+            raise ValueError(f'{diff} rows of {left} are not in {right}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a conn.log database to the compact v2 layout in place.')
+    parser.add_argument('--db_name',
+                        required=True,
+                        help='DuckDB database to convert')
+    parser.add_argument('--log_file',
+                        default='migration.log',
+                        help='Log file name (default: migration.log)')
+    parser.add_argument('--keep_backup',
+                        action='store_true',
+                        help='Keep the original database as <db_name>.v1.bak')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='Compare every row of the converted database with the original before replacing it')
+    parser.add_argument('--log_level',
+                        default='INFO',
+                        help='Logging level (default: INFO)')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log_level.upper(), logging.INFO)
+    setup_logging(args.log_file, log_level)
+
+    con = duckdb.connect(args.db_name)
+    version = schema_version(con)
+    staged = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_staging'").fetchone()[0]
+    # Fold the write-ahead log into the file so its size is comparable
+    con.execute('CHECKPOINT')
+    con.close()
+    if version != 1:
+        print(f'{args.db_name} is already in the v2 layout.')
+        return
+    if staged:
+        print(f'{args.db_name} has rows waiting in logs_staging, finish the import with '
+              'zeek_ingest_connlog_by_source.py --deferred_dedupe first.')
+        return
+
+    logging.info(f'Converting {args.db_name} to the v2 layout.')
+    tmp_name = args.db_name + '.v2.tmp'
+    if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+    con = duckdb.connect(tmp_name)
+    try:
+        con.execute(f"ATTACH '{args.db_name}' AS old (READ_ONLY)")
+        copy_tables(con)
+        rows = migrate(con)
+        if args.verify:
+            verify(con)
+            logging.info('Verified all rows against the original database.')
+        con.execute('DETACH old')
+        con.execute('CHECKPOINT')
+        con.close()
+    except BaseException:
+        con.close()
+        os.remove(tmp_name)
+        raise
+
+    old_size = os.path.getsize(args.db_name)
+    new_size = os.path.getsize(tmp_name)
+    if args.keep_backup:
+        os.replace(args.db_name, args.db_name + '.v1.bak')
+    os.replace(tmp_name, args.db_name)
+
+    reduction = 100 * (old_size - new_size) / old_size if old_size else 0
+    report = (f'Converted {rows} rows. Database size {old_size / 2**20:.1f} MiB -> {new_size / 2**20:.1f} MiB '
+              f'({reduction:.1f}% smaller).')
+    logging.info(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
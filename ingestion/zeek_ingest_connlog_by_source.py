@@ -1,10 +1,134 @@
 import os
+import sys
 import duckdb
 import gzip
+import hashlib
 import ijson
 import argparse
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import queue
+import shutil
+import socket
+import tempfile
+
+
+# Zeek conn.log fields in the column order of the logs table, together with
+# the logs column each field is stored in and its type.
+LOG_FIELDS = [
+    ('ts', 'ts', 'DOUBLE'),
+    ('uid', 'uid', 'STRING'),
+    ('id.orig_h', 'id_orig_h', 'STRING'),
+    ('id.orig_p', 'id_orig_p', 'INTEGER'),
+    ('id.resp_h', 'id_resp_h', 'STRING'),
+    ('id.resp_p', 'id_resp_p', 'INTEGER'),
+    ('proto', 'proto', 'STRING'),
+    ('duration', 'duration', 'DOUBLE'),
+    ('orig_bytes', 'orig_bytes', 'INTEGER'),
+    ('resp_bytes', 'resp_bytes', 'INTEGER'),
+    ('conn_state', 'conn_state', 'STRING'),
+    ('local_orig', 'local_orig', 'BOOLEAN'),
+    ('local_resp', 'local_resp', 'BOOLEAN'),
+    ('missed_bytes', 'missed_bytes', 'INTEGER'),
+    ('history', 'history', 'STRING'),
+    ('orig_pkts', 'orig_pkts', 'INTEGER'),
+    ('orig_ip_bytes', 'orig_ip_bytes', 'INTEGER'),
+    ('resp_pkts', 'resp_pkts', 'INTEGER'),
+    ('resp_ip_bytes', 'resp_ip_bytes', 'INTEGER'),
+]
+
+# Values of the ENUM columns of the compact v2 layout of logs: the transport
+# protocols and connection states Zeek writes to conn.log.
+PROTOCOLS = ['unknown_transport', 'tcp', 'udp', 'icmp']
+CONN_STATES = ['S0', 'S1', 'SF', 'REJ', 'S2', 'S3', 'RSTO', 'RSTR', 'RSTOS0', 'RSTRH', 'SH', 'SHR', 'OTH']
+
+# Bits per key of the Bloom filters of the files, and number of bit positions
+# of a key, for about 1% false positives. cleaning/zeek_purge_from_data.py
+# probes the filters with the same hashes.
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+# Macros converting IP addresses between text and the integers stored in the
+# v2 layout, and classifying flows by address family. They are stored in the
+# database, so the logs view decoding the v2 table works for every tool
+# reading it. Text that is not a valid address converts to NULL. IPv6 text is
+# written in the compressed form of RFC 5952, with IPv4-mapped addresses in
+# the ::ffff:a.b.c.d form. ip_family is 4 or 6 when both ends of a flow are
+# valid addresses of that family, NULL otherwise. Macros are expanded inline,
+# so a value used several times is bound once as the parameter of a lambda
+# over a one-element list, keeping the expansion of nested macros small on
+# constant arguments.
+IP_MACROS = [
+    r"""
+    CREATE OR REPLACE MACRO ipv4_to_int(h) AS
+        CASE WHEN regexp_full_match(h, '((25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])')
+        THEN (split_part(h, '.', 1)::UBIGINT * 16777216 + split_part(h, '.', 2)::UBIGINT * 65536
+              + split_part(h, '.', 3)::UBIGINT * 256 + split_part(h, '.', 4)::UBIGINT)::UINTEGER
+        END
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_groups(h) AS
+        CASE WHEN contains(h, '::') THEN
+            list_concat(
+                list_filter(string_split(split_part(h, '::', 1), ':'), g -> g <> ''),
+                list_resize([]::VARCHAR[], 8 - len(list_filter(string_split(h, ':'), g -> g <> '')), '0'),
+                list_filter(string_split(split_part(h, '::', 2), ':'), g -> g <> ''))
+        ELSE string_split(h, ':')
+        END
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_embedded_v4(h) AS
+        CASE WHEN contains(h, '.') THEN
+            regexp_replace(h, '[^:]*$', '')
+            || printf('%x:%x', ipv4_to_int(regexp_extract(h, '[^:]*$')) // 65536,
+                      ipv4_to_int(regexp_extract(h, '[^:]*$')) % 65536)
+        ELSE h
+        END
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_to_int(h) AS
+        list_transform([ipv6_groups(ipv6_embedded_v4(h))], groups ->
+            CASE WHEN contains(h, ':') AND regexp_full_match(h, '[0-9a-fA-F:.]+') AND len(groups) = 8
+                      AND list_bool_and(list_transform(groups, g -> regexp_full_match(g, '[0-9a-fA-F]{1,4}')))
+            THEN list_reduce(list_transform(groups, g -> ('0x' || g)::INTEGER::UHUGEINT), (acc, g) -> acc * 65536 + g)
+            END)[1]
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ip_family(orig_h, resp_h) AS
+        CASE
+            WHEN ipv4_to_int(orig_h) IS NOT NULL AND ipv4_to_int(resp_h) IS NOT NULL THEN 4
+            WHEN ipv6_to_int(orig_h) IS NOT NULL AND ipv6_to_int(resp_h) IS NOT NULL THEN 6
+        END::UTINYINT
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv4_text(n) AS
+        CASE WHEN n IS NOT NULL THEN
+            concat_ws('.', n // 16777216, n // 65536 % 256, n // 256 % 256, n % 256)
+        END
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_full_text(n) AS
+        printf('%x:%x:%x:%x:%x:%x:%x:%x', n >> 112, (n >> 96) & 65535, (n >> 80) & 65535, (n >> 64) & 65535,
+               (n >> 48) & 65535, (n >> 32) & 65535, (n >> 16) & 65535, n & 65535)
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_compress(addr) AS
+        list_transform([':' || addr || ':'], padded ->
+            CASE WHEN NOT regexp_matches(padded, ':0(:0)+:') THEN trim(padded, ':')
+            ELSE list_transform([list_reduce(regexp_extract_all(padded, ':0(:0)+:'),
+                                             (a, b) -> CASE WHEN length(b) > length(a) THEN b ELSE a END)], run ->
+                ltrim(left(padded, strpos(padded, run) - 1), ':') || '::'
+                || rtrim(right(padded, length(padded) - strpos(padded, run) - length(run) + 1), ':'))[1]
+            END)[1]
+    """,
+    r"""
+    CREATE OR REPLACE MACRO ipv6_text(n) AS
+        list_transform([n], x ->
+            CASE WHEN x >> 32 = 65535 THEN '::ffff:' || ipv4_text(x & 4294967295)
+            ELSE ipv6_compress(ipv6_full_text(x))
+            END)[1]
+    """,
+]
 
 
 def setup_logging(log_file, log_level):
@@ -13,12 +137,12 @@ def setup_logging(log_file, log_level):
                         format='%(asctime)s %(levelname)s:%(message)s')
 
 
-def create_table(con):
+def create_table(con, table='logs', primary_key=True):
     """Create the logs table in the DuckDB database if it doesn't exist."""
-    con.execute('''
-    CREATE TABLE IF NOT EXISTS logs (
+    con.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table} (
         ts DOUBLE,
-        uid STRING PRIMARY KEY,
+        uid STRING{' PRIMARY KEY' if primary_key else ''},
         id_orig_h STRING,
         id_orig_p INTEGER,
         id_resp_h STRING,
@@ -36,69 +160,654 @@ def create_table(con):
         orig_ip_bytes INTEGER,
         resp_pkts INTEGER,
         resp_ip_bytes INTEGER,
-        source STRING
+        source STRING,
+        ip_family UTINYINT
     )
     ''')
     logging.debug('Table created or already exists.')
 
 
-def process_log_file(db_name, file_path, source):
+def create_macros(con):
+    """Create the IP address macros in the DuckDB database."""
+    for macro in IP_MACROS:
+        con.execute(macro)
+
+
+def add_ip_family(con):
+    """
+    Add the ip_family column to databases created before it existed.
+
+    The address family of the flows already stored is backfilled from their
+    IP addresses.
+    """
+    if schema_version(con) == 2:
+        create_logs_view(con)
+    for table in ('logs', 'logs_staging'):
+        columns = [column for column, in con.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", (table,)).fetchall()]
+        if columns and 'ip_family' not in columns:
+            con.execute(f'ALTER TABLE {table} ADD COLUMN ip_family UTINYINT')
+            updated = con.execute(f'UPDATE {table} SET ip_family = ip_family(id_orig_h, id_resp_h)').fetchone()[0]
+            bump_generation(con)
+            logging.info(f'Added ip_family to {table}, backfilled {updated} rows.')
+
+
+def create_manifest_table(con):
+    """Create the table recording every ingested log file if it doesn't exist."""
+    con.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_manifest (
+        path STRING PRIMARY KEY,
+        size BIGINT,
+        mtime DOUBLE,
+        sha256 STRING,
+        row_count BIGINT,
+        source STRING,
+        ingested_at TIMESTAMP,
+        file_id INTEGER
+    )
+    ''')
+    logging.debug('Manifest table created or already exists.')
+
+
+def create_location_tables(con):
+    """
+    Create the location index of the ingested files if it doesn't exist.
+
+    uid_locations lists every uid of a file and ip_locations every address
+    seen as id.orig_h or id.resp_h in it, with the file_id of the file in
+    ingest_manifest. Unlike logs, uids deduplicated away are kept, so the
+    index finds every file a uid or an address occurs in. file_filters has
+    one compact row per file, checked before the index: the range of its
+    uids and of its addresses of each family, and a Bloom filter of them.
+    """
+    columns = [column for column, in con.execute(
+        "SELECT column_name FROM duckdb_columns() WHERE table_name = 'ingest_manifest'").fetchall()]
+    if 'file_id' not in columns:
+        # Files ingested before the index existed keep a NULL file_id
+        con.execute('ALTER TABLE ingest_manifest ADD COLUMN file_id INTEGER')
+        logging.info('Added file_id to ingest_manifest.')
+    con.execute('CREATE TABLE IF NOT EXISTS uid_locations (uid STRING, file_id INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS ip_locations (ip STRING, file_id INTEGER)')
+    con.execute('''
+    CREATE TABLE IF NOT EXISTS file_filters (
+        file_id INTEGER PRIMARY KEY,
+        uid_min STRING,
+        uid_max STRING,
+        ip4_min UINTEGER,
+        ip4_max UINTEGER,
+        ip6_min UHUGEINT,
+        ip6_max UHUGEINT,
+        bloom BLOB
+    )
+    ''')
+    logging.debug('Location tables created or already exist.')
+
+
+def ip_value(text):
+    """Return the address family and integer value of an IP address, or None if it is not one."""
+    try:
+        if ':' in text:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big')
+    except OSError:
+        return None
+
+
+def bloom_filter(keys):
+    """Return a Bloom filter of the given keys, as bytes."""
+    bits = max(64, -(-len(keys) * BLOOM_BITS_PER_KEY // 64) * 64)
+    bloom = bytearray(bits // 8)
+    for key in keys:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for i in range(BLOOM_HASHES):
+            position = (h1 + i * h2) % bits
+            bloom[position >> 3] |= 1 << (position & 7)
+    return bytes(bloom)
+
+
+def file_filter(con, relation):
+    """
+    Return the filter of a file (see create_location_tables) from the uids
+    and addresses of its lines, read from relation: the minimum and maximum
+    uid, IPv4 and IPv6 address, and the Bloom filter of all of them.
+    """
+    uids = [uid for uid, in con.execute(f'SELECT DISTINCT uid FROM {relation} WHERE uid IS NOT NULL').fetchall()]
+    addresses = {4: [], 6: []}
+    for ip, in con.execute(f'''
+        SELECT DISTINCT ip FROM (SELECT id_orig_h AS ip FROM {relation} UNION ALL SELECT id_resp_h FROM {relation})
+        WHERE ip IS NOT NULL
+    ''').fetchall():
+        value = ip_value(ip)
+        if value is not None:
+            addresses[value[0]].append(value[1])
+    keys = [b'u' + uid.encode() for uid in uids]
+    keys += [bytes([family]) + value.to_bytes(4 if family == 4 else 16, 'big')
+             for family, values in addresses.items() for value in values]
+    return (min(uids, default=None), max(uids, default=None),
+            min(addresses[4], default=None), max(addresses[4], default=None),
+            min(addresses[6], default=None), max(addresses[6], default=None),
+            bloom_filter(keys))
+
+
+def index_file(con, file_path, relation):
+    """
+    Record the uids and addresses of the lines of a file, read from relation,
+    in the location index. Return the file_id of the file, the one it already
+    had if it is ingested again.
+    """
+    file_id = con.execute('SELECT file_id FROM ingest_manifest WHERE path = ?', (file_path,)).fetchone()
+    if file_id and file_id[0] is not None:
+        file_id = file_id[0]
+        con.execute('DELETE FROM uid_locations WHERE file_id = ?', (file_id,))
+        con.execute('DELETE FROM ip_locations WHERE file_id = ?', (file_id,))
+    else:
+        file_id = con.execute('SELECT COALESCE(MAX(file_id), 0) + 1 FROM ingest_manifest').fetchone()[0]
+    con.execute(f'INSERT INTO uid_locations SELECT DISTINCT uid, ? FROM {relation} WHERE uid IS NOT NULL',
+                (file_id,))
+    con.execute(f'''
+        INSERT INTO ip_locations
+        SELECT DISTINCT ip, ? FROM (SELECT id_orig_h AS ip FROM {relation} UNION ALL SELECT id_resp_h FROM {relation})
+        WHERE ip IS NOT NULL
+    ''', (file_id,))
+    return file_id
+
+
+def schema_version(con):
+    """
+    Return the layout of the logs data in the database.
+
+    Version 1 stores flows in the logs table as they are read from conn.log.
+    Version 2 stores them in the compact logs_v2 table, and logs is a view
+    presenting them in the version 1 columns.
+    """
+    tables = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_v2'").fetchone()[0]
+    return 2 if tables else 1
+
+
+def enum_sql(values):
+    """Return the SQL type of an ENUM with the given values."""
+    return 'ENUM({})'.format(', '.join("'{}'".format(value.replace("'", "''")) for value in values))
+
+
+def create_v2_table(con, sources):
     """
-    Process a single log file and insert its data into the DuckDB database.
+    Create the compact v2 logs_v2 table and the logs view decoding it.
+
+    Protocols, connection states and sources are ENUMs, timestamps are a
+    TIMESTAMP, and IP addresses are stored as integers in an IPv4 or an IPv6
+    column, with the address family of the flow in ip_family.
     """
-    con = duckdb.connect(db_name)
+    create_macros(con)
+    con.execute(f'''
+    CREATE TABLE logs_v2 (
+        ts TIMESTAMP,
+        uid STRING,
+        ip_family UTINYINT,
+        orig_h4 UINTEGER,
+        orig_h6 UHUGEINT,
+        id_orig_p USMALLINT,
+        resp_h4 UINTEGER,
+        resp_h6 UHUGEINT,
+        id_resp_p USMALLINT,
+        proto {enum_sql(PROTOCOLS)},
+        duration DOUBLE,
+        orig_bytes INTEGER,
+        resp_bytes INTEGER,
+        conn_state {enum_sql(CONN_STATES)},
+        local_orig BOOLEAN,
+        local_resp BOOLEAN,
+        missed_bytes INTEGER,
+        history STRING,
+        orig_pkts INTEGER,
+        orig_ip_bytes INTEGER,
+        resp_pkts INTEGER,
+        resp_ip_bytes INTEGER,
+        source {enum_sql(sorted(sources))}
+    )
+    ''')
+    create_logs_view(con)
+    logging.debug('Table logs_v2 and view logs created.')
+
+
+def create_logs_view(con):
+    """Create the logs view presenting logs_v2 in the columns of the logs table."""
+    con.execute('''
+    CREATE OR REPLACE VIEW logs AS
+    SELECT
+        epoch_us(ts) / 1000000 AS ts,
+        uid,
+        COALESCE(ipv4_text(orig_h4), ipv6_text(orig_h6)) AS id_orig_h,
+        id_orig_p::INTEGER AS id_orig_p,
+        COALESCE(ipv4_text(resp_h4), ipv6_text(resp_h6)) AS id_resp_h,
+        id_resp_p::INTEGER AS id_resp_p,
+        proto::STRING AS proto,
+        duration,
+        orig_bytes,
+        resp_bytes,
+        conn_state::STRING AS conn_state,
+        local_orig,
+        local_resp,
+        missed_bytes,
+        history,
+        orig_pkts,
+        orig_ip_bytes,
+        resp_pkts,
+        resp_ip_bytes,
+        source::STRING AS source,
+        ip_family
+    FROM logs_v2
+    ''')
+
+
+def v2_select_sql():
+    """Return the select list converting rows in the logs columns to the v2 layout."""
+    return '''
+        make_timestamp(round(ts * 1000000)::BIGINT) AS ts,
+        uid,
+        ip_family(id_orig_h, id_resp_h) AS ip_family,
+        ipv4_to_int(id_orig_h) AS orig_h4,
+        CASE WHEN ipv4_to_int(id_orig_h) IS NULL THEN ipv6_to_int(id_orig_h) END AS orig_h6,
+        id_orig_p,
+        ipv4_to_int(id_resp_h) AS resp_h4,
+        CASE WHEN ipv4_to_int(id_resp_h) IS NULL THEN ipv6_to_int(id_resp_h) END AS resp_h6,
+        id_resp_p,
+        proto,
+        duration,
+        orig_bytes,
+        resp_bytes,
+        conn_state,
+        local_orig,
+        local_resp,
+        missed_bytes,
+        history,
+        orig_pkts,
+        orig_ip_bytes,
+        resp_pkts,
+        resp_ip_bytes,
+        source
+    '''
+
+
+def add_sources(con, sources):
+    """Add sources that are not values of the source ENUM of logs_v2 yet."""
+    current = con.execute('SELECT enum_range(ANY_VALUE(source)) FROM logs_v2').fetchone()[0]
+    missing = set(sources) - set(current)
+    if missing:
+        con.execute(f'ALTER TABLE logs_v2 ALTER source TYPE {enum_sql(sorted(set(current) | missing))}')
+        logging.info(f'Added sources to logs_v2: {", ".join(sorted(missing))}')
+
+
+def mark_rollups_dirty(con, relation):
+    """
+    Record the sources and time ranges of flows added to logs from relation.
+
+    Databases with metrics rollups (see metrics/duckdb_metrics.py
+    --build_rollups) have a rollup_dirty table, the rollups of these hours
+    are recomputed the next time metrics are calculated.
+    """
+    if con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'rollup_dirty'").fetchone()[0]:
+        con.execute(f'INSERT INTO rollup_dirty SELECT source, MIN(ts), MAX(ts) FROM {relation} GROUP BY source')
+
+
+def bump_generation(con):
+    """
+    Invalidate the cached metrics results of logs.
+
+    Databases with a metrics cache (see metrics/duckdb_metrics.py) have a
+    logs_generation counter, part of the fingerprint cached results are valid
+    for, incremented on every change to logs.
+    """
+    if con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_generation'").fetchone()[0]:
+        con.execute('UPDATE logs_generation SET generation = generation + 1')
+
+
+def has_primary_key(con, table='logs'):
+    """Return True if the given table has a PRIMARY KEY constraint."""
+    return con.execute(
+        "SELECT COUNT(*) FROM duckdb_constraints() WHERE table_name = ? AND constraint_type = 'PRIMARY KEY'",
+        (table,)
+    ).fetchone()[0] > 0
+
+
+def has_staging(con):
+    """Check whether the database has the logs_staging table."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_staging'").fetchone()[0] > 0
+
+
+def merge_staging(con):
+    """
+    Move the rows of the staging table into the logs table, deduplicated on uid.
+
+    The first row seen for a uid wins: rows already in logs take precedence,
+    and among staged rows the one staged first is kept. Returns the number of
+    staged rows and the number of duplicates dropped.
+    """
+    if schema_version(con) == 2:
+        add_sources(con, [source for source, in con.execute(
+            'SELECT DISTINCT source FROM logs_staging WHERE source IS NOT NULL').fetchall()])
+        table, columns = 'logs_v2', v2_select_sql()
+    else:
+        table, columns = 'logs', '*'
+
+    staged = con.execute('SELECT COUNT(*) FROM logs_staging').fetchone()[0]
+    con.execute('BEGIN TRANSACTION')
+    mark_rollups_dirty(con, 'logs_staging')
+    if staged:
+        bump_generation(con)
+    inserted = con.execute(f'''
+        INSERT INTO {table}
+        SELECT {columns} FROM logs_staging s
+        WHERE s.rowid IN (SELECT MIN(rowid) FROM logs_staging WHERE uid IS NOT NULL GROUP BY uid)
+        AND NOT EXISTS (SELECT 1 FROM {table} l WHERE l.uid = s.uid)
+        ORDER BY s.rowid
+    ''').fetchone()[0]
+    con.execute('DROP TABLE logs_staging')
+    con.execute('COMMIT')
+    return staged, staged - inserted
+
+
+def cluster_logs(con):
+    """
+    Rewrite the stored flows sorted by source and time, so that the min/max
+    statistics DuckDB keeps for every row group (zone maps) let queries on a
+    source or time range skip most of the table.
+
+    In the v2 layout source is an ENUM and the flows are sorted by source
+    and ts. In logs, source is a string whose statistics only keep its first
+    8 bytes, the same for every source named Honeypot-..., so there the flows
+    are sorted by ts alone, which keeps every time range contiguous.
+    """
+    table, order = ('logs_v2', 'source, ts') if schema_version(con) == 2 else ('logs', 'ts')
+    ddl = con.execute('SELECT sql FROM duckdb_tables() WHERE table_name = ?', (table,)).fetchone()[0]
+    con.execute('BEGIN TRANSACTION')
+    con.execute(ddl.replace(f'CREATE TABLE {table}(', f'CREATE TABLE {table}_clustered(', 1))
+    rows = con.execute(f'INSERT INTO {table}_clustered SELECT * FROM {table} ORDER BY {order}').fetchone()[0]
+    con.execute(f'DROP TABLE {table}')
+    con.execute(f'ALTER TABLE {table}_clustered RENAME TO {table}')
+    con.execute('COMMIT')
+    con.execute('CHECKPOINT')
+    logging.info(f'Clustered {rows} rows of {table} by {order}.')
+
+
+def file_sha256(file_path):
+    """Return the SHA-256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def select_files(con, file_paths, source, force=False):
+    """
+    Return the log files that still have to be ingested.
+
+    A file listed in the manifest with the same size and modification time is
+    skipped. If only its size or modification time changed, its content hash
+    decides whether it is ingested again.
+    """
+    manifest = {path: (size, mtime, sha256) for path, size, mtime, sha256 in con.execute(
+        'SELECT path, size, mtime, sha256 FROM ingest_manifest').fetchall()}
+
+    selected = []
+    for file_path in file_paths:
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        file_info = {'path': path, 'source': source, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        if path in manifest and not force:
+            size, mtime, sha256 = manifest[path]
+            if (size, mtime) == (stat.st_size, stat.st_mtime):
+                continue
+            if file_sha256(path) == sha256:
+                con.execute('UPDATE ingest_manifest SET size = ?, mtime = ? WHERE path = ?',
+                            (stat.st_size, stat.st_mtime, path))
+                continue
+        selected.append(file_info)
+    return selected
+
+
+def decode_rows(con, file_path, source):
+    """
+    Decode a log file line by line into the batch table of a worker database.
+
+    Lines that are not a JSON object, have no uid or cannot be converted are
+    logged with their line number and skipped, the rest of the file is still
+    decoded. The uids and addresses of the lines not kept in batch, those
+    skipped and repeated uids, are kept in the rejected table.
+    """
+    create_table(con, 'batch')
+    con.execute('CREATE TABLE rejected (uid STRING, id_orig_h STRING, id_resp_h STRING)')
     with gzip.open(file_path, 'rt') as f:
-        for line in f:
-            # Use ijson to parse the JSON line
-            data = ijson.items(line, '')
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                # Use ijson to parse the JSON line
+                item = next(ijson.items(line, ''))
+            except ijson.JSONError as e:
+                logging.error(f'Error processing line {number} of {file_path}: {line}. Error: {e}')
+                continue
+            if not isinstance(item, dict):
+                logging.error(f'Error processing line {number} of {file_path}: {line}. Error: Not a JSON object')
+                continue
             # Prepare a tuple of values, None if keys are missing
-            for item in data:
-                values = (
-                    item.get('ts', None),
-                    item.get('uid', None),
-                    item.get('id.orig_h', None),
-                    item.get('id.orig_p', None),
-                    item.get('id.resp_h', None),
-                    item.get('id.resp_p', None),
-                    item.get('proto', None),
-                    item.get('duration', None),
-                    item.get('orig_bytes', None),
-                    item.get('resp_bytes', None),
-                    item.get('conn_state', None),
-                    item.get('local_orig', None),
-                    item.get('local_resp', None),
-                    item.get('missed_bytes', None),
-                    item.get('history', None),
-                    item.get('orig_pkts', None),
-                    item.get('orig_ip_bytes', None),
-                    item.get('resp_pkts', None),
-                    item.get('resp_ip_bytes', None),
-                    source
-                )
+            values = tuple(item.get(field, None) for field, _, _ in LOG_FIELDS) + (source,)
+            locations = tuple(str(item[field]) if item.get(field) is not None else None
+                              for field in ('uid', 'id.orig_h', 'id.resp_h'))
+
+            if item.get('uid') is None:
+                logging.error(f'Error processing line {number} of {file_path}: {line}. Error: No uid')
+                inserted = 0
+            else:
+                try:
+                    inserted = con.execute(
+                        '''
+                        INSERT INTO batch VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)
+                        ON CONFLICT(uid) DO NOTHING
+                        ''', values
+                    ).fetchone()[0]
+                except (duckdb.ConversionException, duckdb.InvalidInputException, duckdb.ConstraintException) as e:
+                    logging.error(f'Error processing line {number} of {file_path}: {line}. Error: {e}')
+                    inserted = 0
+            if not inserted:
+                con.execute('INSERT INTO rejected VALUES (?, ?, ?)', locations)
+    con.execute('UPDATE batch SET ip_family = ip_family(id_orig_h, id_resp_h)')
 
+
+def read_json_sql(file_path):
+    """
+    Return a DuckDB table expression reading a gzipped Zeek JSON log.
+
+    All fields are read as text so that values which do not fit the logs
+    column types can be detected per row instead of failing the whole file.
+    """
+    columns = ', '.join(f"'{field}': 'VARCHAR'" for field, _, _ in LOG_FIELDS)
+    path = file_path.replace("'", "''")
+    return (f"read_json('{path}', format='newline_delimited', compression='gzip', "
+            f"columns={{{columns}}}, ignore_errors=true)")
+
+
+def conversion_sql():
+    """
+    Return the SQL expressions used to convert raw text fields.
+
+    These are the select list casting each field to its logs column type,
+    a predicate that holds for rows that have a uid and where every present
+    field converts, and an expression naming the columns that fail to convert.
+    Lines the JSON reader cannot parse are read as rows of NULLs, so the uid
+    check also rejects them.
+    """
+    casts = ', '.join(f'TRY_CAST("{field}" AS {type_}) AS {column}'
+                      for field, column, type_ in LOG_FIELDS)
+    checks = [f'("{field}" IS NULL OR TRY_CAST("{field}" AS {type_}) IS NOT NULL)'
+              for field, _, type_ in LOG_FIELDS]
+    failed = ', '.join(f"CASE WHEN NOT {check} THEN '{column}' END"
+                       for check, (_, column, _) in zip(checks, LOG_FIELDS))
+    return casts, ' AND '.join(['"uid" IS NOT NULL'] + checks), f"concat_ws(', ', {failed})"
+
+
+def decode_columnar(con, file_path, source):
+    """
+    Decode a log file in one columnar pass into the batch table of a worker database.
+
+    The file is read by DuckDB's JSON reader instead of one INSERT per line.
+    Rows without a uid, including lines that are not valid JSON, and rows with
+    values that cannot be converted to the column types are logged and
+    skipped, their uids and addresses are kept in the rejected table.
+    """
+    casts, converts, failed_columns = conversion_sql()
+    con.execute(f'CREATE TEMP TABLE raw_logs AS SELECT * FROM {read_json_sql(file_path)}')
+
+    failed = con.execute(
+        f'SELECT to_json(raw_logs), "uid" IS NULL, {failed_columns} FROM raw_logs WHERE NOT ({converts})'
+    ).fetchall()
+    for line, no_uid, columns in failed:
+        error = 'Line is not valid JSON or has no uid' if no_uid else f'Could not convert {columns}'
+        logging.error(f'Error processing line: {line}. Error: {error}')
+    con.execute(f'''
+        CREATE TABLE rejected AS
+        SELECT "uid" AS uid, "id.orig_h" AS id_orig_h, "id.resp_h" AS id_resp_h
+        FROM raw_logs WHERE NOT ({converts})
+    ''')
+
+    con.execute(f'''
+        CREATE TABLE batch AS
+        SELECT {casts}, ? AS source, ip_family("id.orig_h", "id.resp_h") AS ip_family
+        FROM raw_logs WHERE {converts}
+    ''', (source,))
+    con.execute('DROP TABLE raw_logs')
+
+
+def decode_log_file(con, file_path, source, spool_path, locations_path, bulk):
+    """
+    Decode a single log file into a Parquet batch at the given spool path,
+    and the uids and addresses of all its lines, including the lines that
+    could not be converted, into a Parquet file at locations_path for the
+    location index.
+
+    Returns the path of the batch and its number of rows, or None as the path
+    if the file could not be read.
+    """
+    try:
+        if bulk:
+            decode_columnar(con, file_path, source)
+        else:
+            decode_rows(con, file_path, source)
+        rows = con.execute('SELECT COUNT(*) FROM batch').fetchone()[0]
+        con.execute(f"COPY batch TO '{spool_path}' (FORMAT parquet)")
+        con.execute(f'''
+            COPY (SELECT uid, id_orig_h, id_resp_h FROM batch UNION ALL SELECT * FROM rejected)
+            TO '{locations_path}' (FORMAT parquet)
+        ''')
+    except (OSError, ijson.JSONError, duckdb.IOException, duckdb.InvalidInputException) as e:
+        logging.error(f'Error processing file: {file_path}. Error: {e}')
+        return None, 0
+    finally:
+        con.execute('DROP TABLE IF EXISTS batch')
+        con.execute('DROP TABLE IF EXISTS rejected')
+        con.execute('DROP TABLE IF EXISTS raw_logs')
+    return spool_path, rows
+
+
+def decode_worker(tasks, batches, spool_dir, bulk, log_file, log_level):
+    """
+    Worker process decoding the files it takes from the task queue.
+
+    Decoded batches are put on the bounded batch queue, so workers block once
+    the writer falls behind. A None is put on the queue when the worker is done.
+    """
+    setup_logging(log_file, log_level)
+    con = duckdb.connect(config={'threads': 1})
+    create_macros(con)
+    try:
+        for index, file_info in iter(tasks.get, None):
+            spool_path = os.path.join(spool_dir, f'batch-{index}.parquet')
+            file_info['locations_path'] = os.path.join(spool_dir, f'locations-{index}.parquet')
             try:
-                con.execute(
-                    '''
-                    INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(uid) DO NOTHING
-                    ''', values
-                )
-            except duckdb.ConversionException as e:
-                logging.error(f'Error processing line: {line}. Error: {e}')
-            except duckdb.InvalidInputException as e:
-                logging.error(f'Error processing line: {line}. Error: {e}')
-            except KeyboardInterrupt:
-                exit()
-
-    logging.debug(f'Processed file: {file_path} with source: {source}')
-    con.close()
+                file_info['sha256'] = file_sha256(file_info['path'])
+                file_info['spool_path'], file_info['rows'] = decode_log_file(
+                    con, file_info['path'], file_info['source'], spool_path, file_info['locations_path'], bulk)
+                if file_info['spool_path'] is not None:
+                    file_info['filter'] = file_filter(con, f"read_parquet('{file_info['locations_path']}')")
+            except Exception as e:
+                # One file failing in an unexpected way must not stop the
+                # worker, the files left in its queue would never be decoded
+                logging.exception(f'Error processing file: {file_info["path"]}. Error: {e}')
+                file_info['spool_path'], file_info['rows'] = None, 0
+            batches.put(file_info)
+        batches.put(None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        con.close()
+
+
+def write_batches(con, batches, workers, deferred=False):
+    """
+    Insert decoded batches into the logs table until every worker has finished.
+
+    This is the only connection writing to the database. Each batch is
+    committed in its own transaction together with the manifest entry and the
+    location index of its file, so an interrupted import resumes with the file
+    it was writing. With deferred deduplication the batches are appended to
+    the unindexed staging table instead. Returns False if the workers exited
+    before decoding every file, True otherwise.
+    """
+    if deferred:
+        insert_sql = "INSERT INTO logs_staging SELECT * FROM read_parquet('{}')"
+    else:
+        insert_sql = "INSERT INTO logs SELECT * FROM read_parquet('{}') ON CONFLICT(uid) DO NOTHING"
+
+    running = len(workers)
+    while running:
+        try:
+            batch = batches.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                logging.error('Decoding workers exited unexpectedly.')
+                return False
+            continue
+        if batch is None:
+            running -= 1
+            continue
+
+        file_path, source, spool_path = batch['path'], batch['source'], batch['spool_path']
+        if spool_path is None:
+            continue
+        try:
+            con.execute('BEGIN TRANSACTION')
+            con.execute(insert_sql.format(spool_path))
+            if not deferred:
+                mark_rollups_dirty(con, f"read_parquet('{spool_path}')")
+                bump_generation(con)
+            file_id = index_file(con, file_path, f"read_parquet('{batch['locations_path']}')")
+            con.execute('INSERT OR REPLACE INTO file_filters VALUES (?, ?, ?, ?, ?, ?::UHUGEINT, ?::UHUGEINT, ?)',
+                        (file_id,) + batch['filter'])
+            con.execute(
+                '''
+                INSERT OR REPLACE INTO ingest_manifest
+                (path, size, mtime, sha256, row_count, source, ingested_at, file_id)
+                VALUES (?, ?, ?, ?, ?, ?, current_timestamp, ?)
+                ''',
+                (file_path, batch['size'], batch['mtime'], batch['sha256'], batch['rows'], source, file_id)
+            )
+            con.execute('COMMIT')
+            logging.debug(f'Processed file: {file_path} with source: {source} ({batch["rows"]} rows)')
+        except duckdb.Error as e:
+            con.execute('ROLLBACK')
+            logging.error(f'Error inserting file: {file_path}. Error: {e}')
+        finally:
+            os.remove(spool_path)
+            os.remove(batch['locations_path'])
+    return True
 
 
 def main():
     """Main function to parse arguments and load log data into DuckDB."""
     parser = argparse.ArgumentParser(description="Load log data into DuckDB.")
     parser.add_argument('--log_dir',
-                        help='Folder to read log files from')
+                        help='Folder to read log files from (without it, only upgrades the database)')
     parser.add_argument('--source',
                         help='Source name for the logs')
     parser.add_argument('--db_name',
@@ -110,7 +819,29 @@ def main():
     parser.add_argument('--workers',
                         type=int,
                         default=4,
-                        help='Number of worker threads (default: 4)')
+                        help='Number of worker processes decoding files (default: 4)')
+    parser.add_argument('--queue_depth',
+                        type=int,
+                        default=8,
+                        help='Maximum number of decoded files waiting for the writer (default: 8)')
+    parser.add_argument('--spool_dir',
+                        default=None,
+                        help='Folder for decoded batches waiting for the writer (default: system temp folder)')
+    parser.add_argument('--bulk',
+                        action='store_true',
+                        help='Decode each file in one columnar pass instead of row by row')
+    parser.add_argument('--deferred_dedupe',
+                        action='store_true',
+                        help='Load into an unindexed staging table and deduplicate uids once at the end')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='Create a new database in the compact v2 layout (see duckdb_migrate_logs_v2.py)')
+    parser.add_argument('--cluster',
+                        action='store_true',
+                        help='Sort the stored flows by source and time after the import, for faster filtered metrics')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Ingest files again even if the manifest lists them as unchanged')
     parser.add_argument('--log_level',
                         default='INFO',
                         help='Logging level (default: INFO)')
@@ -121,23 +852,73 @@ def main():
     setup_logging(args.log_file, log_level)
     logging.info('Starting log data import.')
 
+    log_files = [os.path.join(root, file)
+                 for root, _, files in os.walk(args.log_dir)
+                 for file in files if file.startswith('conn.') and file.endswith('.log.gz')] if args.log_dir else []
+
     con = duckdb.connect(args.db_name)
+    create_macros(con)
+    new_database = not con.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'logs'").fetchone()[0]
+    if args.compact and new_database:
+        create_v2_table(con, [args.source])
+    create_table(con, primary_key=not args.deferred_dedupe)
+    create_manifest_table(con)
+    create_location_tables(con)
 
-    create_table(con)
-    con.close()
+    add_ip_family(con)
 
-    files_to_process = [os.path.join(root, file)
-                        for root, _, files in os.walk(args.log_dir)
-                        for file in files if file.startswith('conn.') and file.endswith('.log.gz')]
+    # The manifest already lists the files of rows left staged by an
+    # interrupted deferred run, so they are merged whatever the mode of this run
+    if has_staging(con):
+        staged, duplicates = merge_staging(con)
+        logging.info(f'Merged {staged} rows staged by an earlier run, dropped {duplicates} duplicate uids.')
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        for file_path in files_to_process:
-            executor.submit(process_log_file, args.db_name, file_path, args.source)
+    # Without a uid index on logs there is no conflict check on insert, and
+    # the logs view of a v2 database has none
+    deferred = args.deferred_dedupe or not has_primary_key(con)
+    if deferred:
+        create_table(con, 'logs_staging', primary_key=False)
 
-    logging.info('Data import complete.')
+    files_to_process = select_files(con, log_files, args.source, args.force)
+    logging.info(f'Found {len(log_files)} log files, {len(files_to_process)} new or changed.')
+
+    # Spawn instead of fork, DuckDB is not safe to use in a forked process
+    ctx = multiprocessing.get_context('spawn')
+    tasks = ctx.Queue()
+    batches = ctx.Queue(maxsize=args.queue_depth)
+    for index, file_info in enumerate(files_to_process):
+        tasks.put((index, file_info))
+    for _ in range(args.workers):
+        tasks.put(None)
+
+    spool_dir = tempfile.mkdtemp(prefix='hornet-ingest-', dir=args.spool_dir)
+    workers = [ctx.Process(target=decode_worker,
+                           args=(tasks, batches, spool_dir, args.bulk, args.log_file, log_level),
+                           daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        if not write_batches(con, batches, workers, deferred):
+            sys.exit(f'Import incomplete, the decoding workers exited unexpectedly. See {args.log_file}.')
+        for worker in workers:
+            worker.join()
+        if deferred:
+            staged, duplicates = merge_staging(con)
+            logging.info(f'Deduplicated {staged} staged rows, dropped {duplicates} duplicate uids.')
+        if args.cluster:
+            cluster_logs(con)
+        logging.info('Data import complete.')
+    except KeyboardInterrupt:
+        logging.warning('Import interrupted, the file being written was rolled back.')
+    finally:
+        for worker in workers:
+            worker.terminate()
+        con.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
     """Entry point of the script."""
     main()
-
@@ -1,11 +1,36 @@
+import os
+import re
+import tempfile
+import multiprocessing
+import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import argparse
+import duckdb
+from concurrent.futures import ProcessPoolExecutor
 
-def create_small_multiples_from_wide_csv(csv_file, chart_file):
+from duckdb_metrics import parse_time, parse_timezone, make_filters, logs_relation, connect_parquet, quote
+from duckdb_flows_per_day_per_source import GRANULARITIES, MEASURES
+
+# Facets are drawn off screen in worker processes
+matplotlib.use('Agg')
+
+# Size in inches and resolution of one facet, the same as a subplot of the
+# figure of the CSV mode.
+FACET_SIZE = (16 / 3, 4)
+FACET_DPI = 100
+
+# Default number of points a series is downsampled to, about two per pixel
+# of the width of a facet.
+MAX_POINTS = 1000
+
+def create_small_multiples_from_wide_csv(csv_file, chart_file, sources=None, start=None, end=None):
     """
-    Create small multiples (facet plots) for flows per honeypot source over time.
+    Create small multiples (facet plots) for flows per honeypot source over time,
+    optionally only for the given sources and for days from start (inclusive) to
+    end (exclusive).
     """
     try:
         # Read the CSV file
@@ -17,8 +42,17 @@ def create_small_multiples_from_wide_csv(csv_file, chart_file):
         # Transpose the DataFrame to have dates as the index
         df = df.T
 
-        # Convert the index to datetime
-        df.index = pd.to_datetime(df.index, format='%Y-%m-%d', errors='coerce')
+        # Convert the index to datetime, days and weeks or the hours of
+        # duckdb_flows_per_day_per_source.py --granularity hour
+        df.index = pd.to_datetime(df.index, format='ISO8601', errors='coerce')
+
+        # Keep only the requested sources and days
+        if sources:
+            df = df[[column for column in df.columns if column in sources]]
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df.index < pd.Timestamp(end)]
 
         # Define grid size for small multiples
         n_sources = df.columns.size
@@ -55,11 +89,206 @@ def create_small_multiples_from_wide_csv(csv_file, chart_file):
     except Exception as e:
         print(f"Error creating small multiples: {e}")
 
+# Rendering from DuckDB or Parquet
+def load_series(con, filters=None, granularity='day', measure='flows', timezone='UTC'):
+    """
+    Return the sources of the flows selected by filters and the time series
+    of each one: the start of every hour, day or week in the given time zone
+    from the first to the last bucket with flows, and the measure of the
+    flows of the source in it, 0 for buckets without flows.
+    """
+    local_time = f"(to_timestamp(ts) AT TIME ZONE {quote(timezone)})"
+    result = con.execute(f'''
+    WITH cells AS (
+        SELECT source, date_trunc('{granularity}', {local_time}) AS bucket, {MEASURES[measure]} AS value
+        FROM {logs_relation(con, filters)}
+        GROUP BY source, bucket
+    ),
+    buckets AS (
+        SELECT unnest(range(min(bucket), max(bucket) + INTERVAL 1 {granularity}, INTERVAL 1 {granularity})) AS bucket
+        FROM cells
+    ),
+    sources AS (
+        SELECT source, dense_rank() OVER (ORDER BY source) - 1 AS facet FROM (SELECT DISTINCT source FROM cells)
+    )
+    SELECT facet, source, bucket, CAST(COALESCE(value, 0) AS DOUBLE) AS value
+    FROM sources CROSS JOIN buckets LEFT JOIN cells USING (source, bucket)
+    ORDER BY facet, bucket
+    ''').fetchnumpy()
+    facets = result['facet']
+    if not len(facets):
+        return [], []
+    # Rows are ordered by facet, so each series is a contiguous slice
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(facets)) + 1))
+    ends = np.append(starts[1:], len(facets))
+    sources = [str(result['source'][start]) for start in starts]
+    series = [(result['bucket'][start:end], result['value'][start:end]) for start, end in zip(starts, ends)]
+    return sources, series
+
+
+def lttb(x, y, threshold):
+    """
+    Downsample a series to threshold points with Largest-Triangle-Three-Buckets:
+    the first and last points, and in each of threshold - 2 buckets of the
+    rest the point forming the largest triangle with the point kept in the
+    previous bucket and the average of the next one.
+    """
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return x, y
+    xs = x.astype('int64').astype(float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = xs[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((xs[a] - avg_x) * (y[start:end] - y[a]) - (xs[a] - xs[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+def minmax(x, y, threshold):
+    """
+    Downsample a series to at most threshold points by keeping the minimum
+    and the maximum of each of threshold / 2 equal buckets, in time order.
+    """
+    n = len(x)
+    if n <= threshold:
+        return x, y
+    edges = np.linspace(0, n, max(threshold // 2, 1) + 1).astype(int)
+    keep = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        segment = y[start:end]
+        keep.extend(sorted({start + int(segment.argmin()), start + int(segment.argmax())}))
+    return x[keep], y[keep]
+
+
+# Downsampling methods of --downsample.
+DOWNSAMPLERS = {'lttb': lttb, 'minmax': minmax, 'none': None}
+
+
+def render_facet(task):
+    """Draw the series of one source as an area chart to a PNG file. Return the number of points drawn."""
+    source, x, y, downsample, max_points, chart_file = task
+    if DOWNSAMPLERS[downsample] is not None:
+        x, y = DOWNSAMPLERS[downsample](x, y, max_points)
+    fig, ax = plt.subplots(figsize=FACET_SIZE, dpi=FACET_DPI)
+    ax.fill_between(x, y, alpha=0.7, color='tab:blue', linewidth=0)
+    ax.plot(x, y, color='tab:blue', linewidth=0.8)
+    ax.set_title(source, fontsize=10)
+    ax.set_ylim(bottom=0)
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.tick_params(axis='x', rotation=45)
+    fig.tight_layout()
+    fig.savefig(chart_file, dpi=FACET_DPI)
+    plt.close(fig)
+    return len(x)
+
+
+def render_title(title, width):
+    """Return a strip of the given width in pixels with the title of a tiled chart, as RGBA bytes."""
+    fig = plt.figure(figsize=(width / FACET_DPI, 0.6), dpi=FACET_DPI)
+    fig.text(0.5, 0.5, title, fontsize=14, ha='center', va='center')
+    fig.canvas.draw()
+    strip = np.asarray(fig.canvas.buffer_rgba())[:, :width].copy()
+    plt.close(fig)
+    return strip
+
+
+def tile_images(image_files, n_cols, title, chart_file):
+    """
+    Tile the facet images into one image, n_cols per row, under the title.
+    Images are read and placed one at a time into the final image.
+    """
+    first = plt.imread(image_files[0])
+    height, width = first.shape[:2]
+    strip = render_title(title, width * n_cols)
+    n_rows = -(-len(image_files) // n_cols)
+    canvas = np.full((strip.shape[0] + height * n_rows, width * n_cols, 4), 255, dtype=np.uint8)
+    canvas[:strip.shape[0]] = strip
+    for idx, image_file in enumerate(image_files):
+        image = plt.imread(image_file)
+        if image.shape[2] == 3:
+            image = np.dstack([image, np.ones(image.shape[:2], dtype=image.dtype)])
+        image = (image[:height, :width] * 255).astype(np.uint8)
+        row, col = divmod(idx, n_cols)
+        top = strip.shape[0] + row * height
+        canvas[top:top + image.shape[0], col * width:col * width + image.shape[1]] = image
+    plt.imsave(chart_file, canvas)
+
+
+def facet_file_name(source):
+    """Return the name of the image file of a source, with characters unsafe in file names replaced."""
+    return re.sub(r'[^\w.-]', '_', source) + '.png'
+
+
+def create_small_multiples_from_db(con, chart_file=None, chart_dir=None, filters=None, granularity='day',
+                                   measure='flows', timezone='UTC', downsample='lttb', max_points=MAX_POINTS,
+                                   workers=None, n_cols=3):
+    """
+    Create small multiples of the measure of the flows of every source over
+    time, read from the logs of a database or Parquet export and grouped per
+    hour, day or week by DuckDB. Series longer than max_points are downsampled,
+    and the facets are drawn by a pool of worker processes, then tiled into
+    chart_file or written as one image per source to chart_dir.
+    """
+    sources, series = load_series(con, filters, granularity, measure, timezone)
+    if not sources:
+        print("No flows match the given filters, no chart written")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = chart_dir or tmp_dir
+        os.makedirs(out_dir, exist_ok=True)
+        image_files = [os.path.join(out_dir, facet_file_name(source)) for source in sources]
+        tasks = [(source, np.asarray(x), np.asarray(y), downsample, max_points, image_file)
+                 for source, (x, y), image_file in zip(sources, series, image_files)]
+        # Spawn instead of fork, DuckDB is not safe to use in a forked process,
+        # and the facets only get the plain arrays of their series
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            points = sum(executor.map(render_facet, tasks))
+
+        if chart_dir:
+            print(f"{len(sources)} charts ({points} points) saved to {chart_dir}")
+            return
+        title = f"{measure.replace('_', ' ').title()} Per {granularity.title()} Per Honeypot - Small Multiples"
+        tile_images(image_files, min(n_cols, len(sources)), title, chart_file)
+    print(f"Chart of {len(sources)} sources ({points} points) saved to {chart_file}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate small multiples for flows per honeypot source.")
-    parser.add_argument("--csv_file", required=True, help="Path to the input CSV file.")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument("--csv_file", help="Path to the input CSV file.")
+    data.add_argument("--db_name", help="Read the flows from this DuckDB database instead of a CSV file.")
+    data.add_argument("--parquet_dir", help="Read the flows from this Parquet export instead of a CSV file.")
     parser.add_argument("--chart_file", default="/tmp/flows_small_multiples.png", help="Path to save the output chart.")
+    parser.add_argument("--chart_dir", help="With --db_name or --parquet_dir, save one chart per source to this folder instead.")
+    parser.add_argument("--source", action="append", help="Only chart this source (can be repeated).")
+    parser.add_argument("--start", type=parse_time, help="Only chart days from this date on, e.g. 2024-05-01.")
+    parser.add_argument("--end", type=parse_time, help="Only chart days before this date.")
+    parser.add_argument("--granularity", choices=list(GRANULARITIES), default="day",
+                        help="With --db_name or --parquet_dir, time bucket of the series (default: day).")
+    parser.add_argument("--measure", choices=list(MEASURES), default="flows",
+                        help="With --db_name or --parquet_dir, value charted: flows, bytes, packets or unique source IPs (default: flows).")
+    parser.add_argument("--timezone", type=parse_timezone, default="UTC",
+                        help="With --db_name or --parquet_dir, time zone of the buckets (default: UTC).")
+    parser.add_argument("--downsample", choices=list(DOWNSAMPLERS), default="lttb",
+                        help="With --db_name or --parquet_dir, how series longer than --max_points are reduced (default: lttb).")
+    parser.add_argument("--max_points", type=int, default=MAX_POINTS,
+                        help=f"Number of points a series is downsampled to (default: {MAX_POINTS}).")
+    parser.add_argument("--workers", type=int, help="Number of processes drawing charts (default: number of CPUs).")
     args = parser.parse_args()
 
-    create_small_multiples_from_wide_csv(args.csv_file, args.chart_file)
-
+    if args.csv_file:
+        create_small_multiples_from_wide_csv(args.csv_file, args.chart_file, args.source, args.start, args.end)
+    else:
+        con = connect_parquet(args.parquet_dir) if args.parquet_dir else duckdb.connect(args.db_name, read_only=True)
+        create_small_multiples_from_db(con, args.chart_file, args.chart_dir,
+                                       make_filters(args.source, args.start, args.end), args.granularity,
+                                       args.measure, args.timezone, args.downsample, args.max_points, args.workers)
+        con.close()
@@ -1,49 +1,95 @@
 import duckdb
-import pandas as pd
 import argparse
 
-# to_timestamp(ts)::timestamptz AS date,
-# CAST(to_timestamp(ts) AS DATE) AS date,
-def flows_per_honeypot_per_day(db_name, output_csv, timezone='UTC'):
-    """Generate a CSV with the number of flows per honeypot source per day."""
-    con = duckdb.connect(db_name)
-    
-    # Query to get the number of flows per honeypot per day
-    query = """
-    SELECT 
-        source, 
-        CAST(to_timestamp(ts) AT TIME ZONE '{timezone}' AS DATE) AS date,
-        COUNT(*) as flow_count
-    FROM 
-        logs
-    GROUP BY 
-        source, date
-    ORDER BY 
-        source, date;
+from duckdb_metrics import AGGREGATES, parse_time, parse_timezone, make_filters, logs_relation, connect_parquet, quote
+
+# Time buckets of the columns of the matrix, each one an expression of the
+# local time of a flow (a TIMESTAMP) naming its bucket.
+GRANULARITIES = {
+    'hour': "strftime(date_trunc('hour', {}), '%Y-%m-%d %H:00')",
+    'day': 'CAST({} AS DATE)',
+    'week': "CAST(date_trunc('week', {}) AS DATE)",
+}
+
+# Values of the cells of the matrix, each one an aggregate of the flows of a
+# source and time bucket.
+MEASURES = {
+    'flows': AGGREGATES['flows'][0],
+    'bytes': AGGREGATES['bytes'][0],
+    'packets': AGGREGATES['packets'][0],
+    'unique_ips': 'COUNT(DISTINCT id_orig_h)',
+}
+
+
+def flows_per_honeypot_per_day(db_name, output_csv, timezone='UTC', filters=None, parquet_dir=None,
+                               granularity='day', measure='flows'):
+    """
+    Generate a CSV with one row per honeypot source and one column per day
+    (or hour, or week starting on Monday) in the given time zone, with the
+    number of flows (or bytes, packets or unique source IPs) of the flows
+    selected by filters (see duckdb_metrics.make_filters), from the database
+    or from the Parquet export in parquet_dir.
+
+    The flows are aggregated per source and time bucket into a temporary
+    table, which DuckDB pivots and writes to the CSV, so that only the
+    aggregated cells are ever kept in memory.
     """
-    
-    # Execute the query and load into a pandas DataFrame
-    df = con.execute(query).df()
-    
-    # Pivot the DataFrame to have honeypots as rows and days as columns
-    pivot_df = df.pivot(index='source', columns='date', values='flow_count').fillna(0)
-    
-    # Save the result to a CSV file
-    pivot_df.to_csv(output_csv)
-    
+    con = connect_parquet(parquet_dir) if parquet_dir else duckdb.connect(db_name)
+
+    local_time = f"(to_timestamp(ts) AT TIME ZONE {quote(timezone)})"
+    con.execute(f'''
+    CREATE TEMP TABLE cells AS
+    SELECT
+        source,
+        {GRANULARITIES[granularity].format(local_time)} AS bucket,
+        {MEASURES[measure]} AS value
+    FROM
+        {logs_relation(con, filters)}
+    GROUP BY
+        source, bucket
+    ''')
+    sources, buckets = con.execute('SELECT COUNT(DISTINCT source), COUNT(DISTINCT bucket) FROM cells').fetchone()
+    if not sources:
+        con.close()
+        print("No flows match the given filters, no CSV written")
+        return
+
+    # Sources without flows in a bucket count 0
+    con.execute(f'''
+    COPY (
+        SELECT source, COALESCE(COLUMNS(* EXCLUDE (source)), 0)
+        FROM (PIVOT cells ON bucket USING first(value) GROUP BY source)
+        ORDER BY source
+    ) TO {quote(output_csv)} (FORMAT csv, HEADER)
+    ''')
+
     con.close()
-    print(f"CSV with flows per honeypot per day saved to {output_csv}")
+    print(f"CSV with {measure} per honeypot per {granularity} ({sources} sources, {buckets} columns) "
+          f"saved to {output_csv}")
 
 def main():
     """Main function to parse arguments and run the flow aggregation."""
     parser = argparse.ArgumentParser(description="Generate CSV with flows per honeypot per day from DuckDB.")
-    parser.add_argument('--db_name', required=True, help='Path to the DuckDB database file')
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument('--db_name', help='Path to the DuckDB database file')
+    data.add_argument('--parquet_dir', help='Folder of a Parquet export of the database to read instead')
     parser.add_argument('--output_csv', required=True, help='Path to the output CSV file')
-    
+    parser.add_argument('--granularity', choices=list(GRANULARITIES), default='day',
+                        help='Time bucket of each column (default: day)')
+    parser.add_argument('--measure', choices=list(MEASURES), default='flows',
+                        help='Value of each cell: flows, bytes, packets or unique source IPs (default: flows)')
+    parser.add_argument('--timezone', type=parse_timezone, default='UTC',
+                        help='Time zone the hours, days and weeks are in, e.g. Europe/Prague (default: UTC)')
+    parser.add_argument('--source', action='append', help='Only count the flows of this source (can be repeated)')
+    parser.add_argument('--start', type=parse_time, help='Only count flows from this UTC date or time on')
+    parser.add_argument('--end', type=parse_time, help='Only count flows before this UTC date or time')
+
     args = parser.parse_args()
-    
-    flows_per_honeypot_per_day(args.db_name, args.output_csv)
+
+    flows_per_honeypot_per_day(args.db_name, args.output_csv, timezone=args.timezone,
+                               filters=make_filters(args.source, args.start, args.end),
+                               parquet_dir=args.parquet_dir, granularity=args.granularity,
+                               measure=args.measure)
 
 if __name__ == '__main__':
     main()
-
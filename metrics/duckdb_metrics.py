@@ -1,6 +1,317 @@
+import os
+import sys
+import glob
 import duckdb
+import pandas
 import argparse
 import logging
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from datetime import datetime, timezone
+
+
+# Columns logs can be grouped by when computing the flow totals, in the order
+# of the GROUP BY.
+FLOW_KEYS = ['source', 'proto', 'ip_family', 'id_resp_p']
+
+# Additive aggregates of logs. They are computed in one scan of logs into the
+# flow_totals table, grouped by the keys every requested metric needs, and
+# each metric sums them up again at its own grouping. Each entry is the
+# aggregate over logs and the expression adding it up over pre-aggregated
+# groups of the same type.
+AGGREGATES = {
+    'flows': ('COUNT(*)', 'SUM(flows)::BIGINT'),
+    'bytes': ('SUM(CAST(orig_bytes AS BIGINT) + CAST(resp_bytes AS BIGINT))', 'SUM(bytes)'),
+    'packets': ('SUM(CAST(orig_pkts AS BIGINT) + CAST(resp_pkts AS BIGINT))', 'SUM(packets)'),
+}
+
+# Grain of the flow_rollup table, flows pre-aggregated per source, hour,
+# protocol, address family and destination port. Metrics grouped by any of
+# these keys are answered from it instead of scanning logs.
+ROLLUP_KEYS = ['source', 'hour', 'proto', 'ip_family', 'id_resp_p']
+
+# Hour of a ts in seconds since the epoch, as a UTC TIMESTAMP.
+ROLLUP_HOUR = 'make_timestamp(CAST(floor({} / 3600) * 3600000000 AS BIGINT))'
+
+# Day of a ts in seconds since the epoch, as a UTC DATE.
+SKETCH_DAY = "(DATE '1970-01-01' + CAST(floor({} / 86400) AS INTEGER))"
+
+# HyperLogLog sketches of the source IPs of each source and day are kept in
+# the ip_sketches table, one row per non-empty register. The register of an
+# IP is the first SKETCH_PRECISION bits of a 64-bit hash of it, and its value
+# the position of the first set bit in the rest of the hash. Sketches merge
+# by taking the maximum of each register, and a count estimated from
+# 2^SKETCH_PRECISION registers has a standard error of 1.04 / sqrt(2^14).
+SKETCH_PRECISION = 14
+SKETCH_REGISTERS = 2 ** SKETCH_PRECISION
+SKETCH_ERROR = 1.04 / SKETCH_REGISTERS ** 0.5
+
+# In-memory database attached to the connection holding the intermediate
+# tables of the metrics, so that every cursor of the connection sees them.
+SCRATCH = 'metrics_scratch'
+
+# Default file of the --profile report and number of operators in its summary.
+PROFILE_FILE = 'metrics_profile.json'
+PROFILE_TOP = 10
+
+# File extension and COPY options of each --output_format.
+OUTPUT_FORMATS = {
+    'csv': ('csv', 'FORMAT csv, HEADER'),
+    'json': ('json', 'FORMAT json, ARRAY true'),
+    'parquet': ('parquet', 'FORMAT parquet'),
+}
+
+# Default bound of the total size of the results kept in metric_cache, in MiB.
+CACHE_SIZE = 64
+
+# Metrics, each one a query over the tables computed by prepare_metrics and
+# the way its result is printed:
+#   - keys/aggregates: the flow_totals grouping and aggregates it needs
+#   - distinct_keys: the source_ips grouping it needs, for distinct source IP counts
+#   - approx_query: the query estimating the distinct source IP counts from
+#     source_sketches, the ip_sketches registers of each source merged over
+#     the selected days, instead, used with --approx
+#   - output: 'value' prints format with the single value of the result,
+#     'rows' prints title and format for every row, 'table' prints the result
+#     as a DataFrame
+#   - params: default values of the parameters in the query
+#   - error: message printed instead of failing when the query fails
+METRICS = {
+    'total_bytes': {
+        'keys': [],
+        'aggregates': ['bytes'],
+        'query': 'SELECT SUM(bytes) FROM flow_totals',
+        'output': 'value',
+        'format': 'Total bytes: {}',
+        'blank_line': True,
+    },
+    'total_packets': {
+        'keys': [],
+        'aggregates': ['packets'],
+        'query': 'SELECT SUM(packets) FROM flow_totals',
+        'output': 'value',
+        'format': 'Total packets: {}',
+        'blank_line': True,
+    },
+    'total_flows': {
+        'keys': [],
+        'aggregates': ['flows'],
+        'query': 'SELECT COALESCE(SUM(flows), 0)::BIGINT FROM flow_totals',
+        'output': 'value',
+        'format': 'Total flows: {}',
+        'blank_line': True,
+    },
+    'total_flows_ipv4': {
+        'keys': ['ip_family'],
+        'aggregates': ['flows'],
+        'query': 'SELECT COALESCE(SUM(flows), 0)::BIGINT FROM flow_totals WHERE ip_family = 4',
+        'output': 'value',
+        'format': 'Total IPv4 flows calculated: {}',
+        'blank_line': True,
+        'error': 'Error calculating IPv4 flows',
+    },
+    'total_flows_ipv6': {
+        'keys': ['ip_family'],
+        'aggregates': ['flows'],
+        'query': 'SELECT COALESCE(SUM(flows), 0)::BIGINT FROM flow_totals WHERE ip_family = 6',
+        'output': 'value',
+        'format': 'Total IPv6 flows calculated: {}',
+        'error': 'Error calculating IPv6 flows',
+    },
+    'protocol_summary': {
+        'keys': ['ip_family', 'proto'],
+        'aggregates': ['flows'],
+        'query': '''
+            SELECT
+                CASE ip_family
+                    WHEN 4 THEN 'IPv4'
+                    WHEN 6 THEN 'IPv6'
+                END AS "IP Proto",
+                SUM(flows)::BIGINT AS "Total Flows",
+                SUM(CASE WHEN proto = 'tcp' THEN flows ELSE 0 END) AS "TCP Flows",
+                SUM(CASE WHEN proto = 'udp' THEN flows ELSE 0 END) AS "UDP Flows",
+                SUM(CASE WHEN proto = 'icmp' THEN flows ELSE 0 END) AS "ICMP Flows"
+            FROM flow_totals
+            GROUP BY "IP Proto"
+        ''',
+        'output': 'table',
+        'title': 'Total flows grouped by IPv4/IPv6 and protocol):',
+        'error': 'Error generating protocol summary',
+    },
+    'flows_by_protocol_and_source': {
+        'keys': ['source', 'proto', 'ip_family'],
+        'aggregates': ['flows'],
+        'query': '''
+            SELECT
+                source as "Honeypot Name (Source)",
+                SUM(flows)::BIGINT AS total_flows,
+                SUM(CASE WHEN ip_family = 4 THEN flows ELSE 0 END) AS ipv4_flows,
+                SUM(CASE WHEN ip_family = 6 THEN flows ELSE 0 END) AS ipv6_flows,
+                SUM(CASE WHEN proto = 'tcp' THEN flows ELSE 0 END) AS total_tcp_flows,
+                SUM(CASE WHEN proto = 'udp' THEN flows ELSE 0 END) AS total_udp_flows,
+                SUM(CASE WHEN proto = 'icmp' THEN flows ELSE 0 END) AS total_icmp_flows,
+                SUM(CASE WHEN proto = 'tcp' AND ip_family = 4 THEN flows ELSE 0 END) AS ipv4_tcp_flows,
+                SUM(CASE WHEN proto = 'udp' AND ip_family = 4 THEN flows ELSE 0 END) AS ipv4_udp_flows,
+                SUM(CASE WHEN proto = 'icmp' AND ip_family = 4 THEN flows ELSE 0 END) AS ipv4_icmp_flows,
+                SUM(CASE WHEN proto = 'tcp' AND ip_family = 6 THEN flows ELSE 0 END) AS ipv6_tcp_flows,
+                SUM(CASE WHEN proto = 'udp' AND ip_family = 6 THEN flows ELSE 0 END) AS ipv6_udp_flows,
+                SUM(CASE WHEN proto = 'icmp' AND ip_family = 6 THEN flows ELSE 0 END) AS ipv6_icmp_flows
+            FROM flow_totals
+            GROUP BY "Honeypot Name (Source)"
+            ORDER BY "Honeypot Name (Source)"
+        ''',
+        'output': 'table',
+        'error': 'Error calculating flows by protocol and source',
+    },
+    'packets_per_honeypot_source': {
+        'keys': ['source'],
+        'aggregates': ['packets'],
+        'query': 'SELECT source, SUM(packets) as packet_count FROM flow_totals GROUP BY source ORDER BY source',
+        'output': 'rows',
+        'title': 'Amount of packets per honeypot location source:',
+        'format': 'Source: {}, Packet Count: {}',
+        'blank_line': True,
+    },
+    'bytes_per_honeypot_source': {
+        'keys': ['source'],
+        'aggregates': ['bytes'],
+        'query': 'SELECT source, SUM(bytes) as byte_count FROM flow_totals GROUP BY source ORDER BY source',
+        'output': 'rows',
+        'title': 'Amount of bytes per honeypot location source:',
+        'format': 'Source: {}, Byte Count: {}',
+        'blank_line': True,
+    },
+    'flows_per_honeypot_source': {
+        'keys': ['source'],
+        'aggregates': ['flows'],
+        'query': 'SELECT source, SUM(flows)::BIGINT as flow_count FROM flow_totals GROUP BY source ORDER BY source',
+        'output': 'rows',
+        'title': 'Amount of flows per honeypot location source:',
+        'format': 'Source: {}, Flow Count: {}',
+        'blank_line': True,
+    },
+    'unique_source_ips': {
+        'distinct_keys': [],
+        'query': 'SELECT COUNT(DISTINCT id_orig_h) as unique_ips FROM source_ips',
+        'approx_query': '''
+            SELECT hll_estimate(list(rho)) as unique_ips
+            FROM (SELECT register, MAX(rho) AS rho FROM source_sketches GROUP BY register)
+        ''',
+        'output': 'value',
+        'format': 'Total unique source IP addresses: {}',
+        'blank_line': True,
+    },
+    'unique_source_ips_per_honeypot': {
+        'distinct_keys': ['source'],
+        'query': 'SELECT source, COUNT(id_orig_h) as unique_ips FROM source_ips GROUP BY source ORDER BY source',
+        'approx_query': '''
+            SELECT source, hll_estimate(list(rho)) as unique_ips
+            FROM source_sketches
+            GROUP BY source
+            ORDER BY source
+        ''',
+        'output': 'rows',
+        'title': 'Total unique source IP addresses per honeypot location source:',
+        'format': 'Source: {}, Unique IPs: {}',
+        'blank_line': True,
+    },
+    'honeypot_summary': {
+        'keys': ['source'],
+        'aggregates': ['flows', 'bytes', 'packets'],
+        'distinct_keys': ['source'],
+        'query': '''
+            SELECT
+                t.source AS "Honeypot Name (Source)",
+                t.flows AS "Total Number of Network Flows",
+                i.unique_ips AS "Total Number of Unique Src IPs",
+                t.bytes AS "Total Number of Bytes",
+                t.packets AS "Total Number of Packets"
+            FROM (SELECT source, SUM(flows)::BIGINT AS flows, SUM(bytes) AS bytes, SUM(packets) AS packets
+                  FROM flow_totals GROUP BY source) t
+            JOIN (SELECT source, COUNT(id_orig_h) AS unique_ips
+                  FROM source_ips GROUP BY source) i
+            ON t.source IS NOT DISTINCT FROM i.source
+            ORDER BY t.source
+        ''',
+        'approx_query': '''
+            SELECT
+                t.source AS "Honeypot Name (Source)",
+                t.flows AS "Total Number of Network Flows",
+                i.unique_ips AS "Total Number of Unique Src IPs",
+                t.bytes AS "Total Number of Bytes",
+                t.packets AS "Total Number of Packets"
+            FROM (SELECT source, SUM(flows)::BIGINT AS flows, SUM(bytes) AS bytes, SUM(packets) AS packets
+                  FROM flow_totals GROUP BY source) t
+            LEFT JOIN (SELECT source, hll_estimate(list(rho)) AS unique_ips
+                       FROM source_sketches GROUP BY source) i
+            ON t.source IS NOT DISTINCT FROM i.source
+            ORDER BY t.source
+        ''',
+        'output': 'table',
+        'error': 'Error generating honeypot summary',
+    },
+    'top_tcp_ports': {
+        'keys': ['proto', 'id_resp_p'],
+        'aggregates': ['flows'],
+        'query': '''
+            SELECT
+                id_resp_p AS "TCP Port",
+                SUM(flows)::BIGINT AS "Total Network Flows"
+            FROM flow_totals
+            WHERE proto = 'tcp'
+            GROUP BY id_resp_p
+            ORDER BY "Total Network Flows" DESC, id_resp_p
+            LIMIT {top_n}
+        ''',
+        'params': {'top_n': 10},
+        'output': 'table',
+        'error': 'Error calculating flows per destination port',
+    },
+    'top_udp_ports': {
+        'keys': ['proto', 'id_resp_p'],
+        'aggregates': ['flows'],
+        'query': '''
+            SELECT
+                id_resp_p AS "UDP Port",
+                SUM(flows)::BIGINT AS "Total Network Flows"
+            FROM flow_totals
+            WHERE proto = 'udp'
+            GROUP BY id_resp_p
+            ORDER BY "Total Network Flows" DESC, id_resp_p
+            LIMIT {top_n}
+        ''',
+        'params': {'top_n': 10},
+        'output': 'table',
+        'error': 'Error calculating flows per destination port',
+    },
+}
+
+# Tables printed by --metrics, with their titles.
+REPORT = [
+    ('Table 1: CTU Hornet 65 Niner dataset metrics overview per honeypot during the 65 days', 'honeypot_summary'),
+    ('Table 2 and 3: CTU Hornet 65 Niner dataset total network flows by L3 and L4', 'flows_by_protocol_and_source'),
+    ('Table 4: Top 10 TCP destination ports by total number of network flows', 'top_tcp_ports'),
+    ('Table 5: Top 10 UDP destination ports by total number of network flows', 'top_udp_ports'),
+]
+
+# Command line flags and the metrics they print, in the order they are printed.
+FLAGS = [
+    ('total_flows', ['total_flows']),
+    ('total_flows_ipv4', ['total_flows_ipv4']),
+    ('total_flows_ipv6', ['total_flows_ipv6']),
+    ('total_bytes', ['total_bytes']),
+    ('total_packets', ['total_packets']),
+    ('flows_by_proto_source', ['flows_by_protocol_and_source']),
+    ('packets_per_honeypot_source', ['packets_per_honeypot_source']),
+    ('bytes_per_honeypot_source', ['bytes_per_honeypot_source']),
+    ('flows_per_honeypot_source', ['flows_per_honeypot_source']),
+    ('unique_source_ips', ['unique_source_ips']),
+    ('unique_source_ips_per_honeypot', ['unique_source_ips_per_honeypot']),
+    ('flows_by_top_dst_ports', ['top_tcp_ports', 'top_udp_ports']),
+]
 
 
 def setup_logging(log_file, log_level):
@@ -32,6 +343,816 @@ def check_db_info(con):
     print()
 
 
+def has_ip_family(con):
+    """Check that the logs table has the ip_family column the IPv4/IPv6 metrics use."""
+    columns = [col[1] for col in con.execute("PRAGMA table_info('logs');").fetchall()]
+    if 'ip_family' not in columns:
+        print("The logs table has no ip_family column. Add it by running "
+              "ingestion/zeek_ingest_connlog_by_source.py --db_name <db> once.")
+        return False
+    return True
+
+
+# Filters
+def parse_time(value):
+    """Parse a --start or --end date or time in ISO 8601 format, in UTC unless it has a time zone."""
+    try:
+        value = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date or time: {value}')
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_timezone(value):
+    """Check a --timezone against the time zones DuckDB knows, matched without regard to case."""
+    if not duckdb.execute('SELECT COUNT(*) FROM pg_timezone_names() WHERE lower(name) = lower(?)',
+                          [value]).fetchone()[0]:
+        raise argparse.ArgumentTypeError(f'unknown time zone: {value}, e.g. UTC or Europe/Prague')
+    return value
+
+
+def make_filters(sources=None, start=None, end=None):
+    """
+    Return the filters selecting the flows metrics are computed from: the
+    given sources, and a ts from start (inclusive) to end (exclusive). None
+    when the metrics are computed from all flows.
+    """
+    if not sources and start is None and end is None:
+        return None
+    return {'sources': sorted(set(sources)) if sources else None, 'start': start, 'end': end}
+
+
+def quote(value):
+    """Return a string as an SQL literal."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def epoch_literal(value):
+    """Return a UTC time as an SQL literal of seconds since the epoch."""
+    return repr(value.replace(tzinfo=timezone.utc).timestamp())
+
+
+def timestamp_literal(value):
+    """Return a UTC time as an SQL TIMESTAMP literal."""
+    return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+
+
+def date_literal(value):
+    """Return the day of a UTC time as an SQL DATE literal."""
+    return f"DATE '{value.date().isoformat()}'"
+
+
+def filter_where(filters, ts_column='ts', ts_literal=epoch_literal, source_literal=quote):
+    """
+    Return the WHERE clause selecting the filtered flows of a relation, with
+    times compared to ts_column as ts_literal values. source_literal returns
+    None for sources the relation cannot contain.
+    """
+    if filters is None:
+        return ''
+    conditions = []
+    if filters['sources']:
+        sources = [literal for literal in map(source_literal, filters['sources']) if literal is not None]
+        conditions.append(f'source IN ({", ".join(sources)})' if sources else 'false')
+    if filters['start'] is not None:
+        conditions.append(f"{ts_column} >= {ts_literal(filters['start'])}")
+    if filters['end'] is not None:
+        conditions.append(f"{ts_column} < {ts_literal(filters['end'])}")
+    return 'WHERE ' + ' AND '.join(conditions)
+
+
+def aligned(filters, unit):
+    """Check whether the time range of the filters starts and ends on a whole 'hour' or 'day'."""
+    if filters is None:
+        return True
+    for value in (filters['start'], filters['end']):
+        if value is not None and (value.minute, value.second, value.microsecond) != (0, 0, 0):
+            return False
+        if value is not None and unit == 'day' and value.hour != 0:
+            return False
+    return True
+
+
+def logs_relation(con, filters):
+    """
+    Return the relation of the filtered flows of logs, to be used in place of
+    logs in a FROM clause.
+
+    The conditions are on the stored columns, so that DuckDB skips the row
+    groups whose min/max statistics (zone maps) are out of range. In the v2
+    layout they are applied to logs_v2 under the select list of the logs view,
+    with times as TIMESTAMP and sources as values of its ENUM, since filters
+    on the decoded columns of the view cannot use the statistics. Over a
+    Parquet export they also select the date partitions, so that only the
+    files of the selected sources and days are read.
+    """
+    if filters is None:
+        return 'logs'
+    if con.execute("SELECT COUNT(*) FROM duckdb_views() WHERE view_name = 'logs_parquet'").fetchone()[0]:
+        return f'(SELECT * EXCLUDE (date) FROM logs_parquet {parquet_where(filters)}) AS logs'
+    if not con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'logs_v2'").fetchone()[0]:
+        return f'(SELECT * FROM logs {filter_where(filters)}) AS logs'
+    view = con.execute("SELECT sql FROM duckdb_views() WHERE view_name = 'logs'").fetchone()[0]
+    select = view[view.index(' AS SELECT ') + len(' AS '):].rstrip().rstrip(';')
+    enum_type = con.execute(
+        "SELECT data_type FROM duckdb_columns() WHERE table_name = 'logs_v2' AND column_name = 'source'").fetchone()[0]
+    known = set(con.execute(f'SELECT enum_range(NULL::{enum_type})').fetchone()[0])
+    where = filter_where(filters, 'ts', timestamp_literal,
+                         lambda source: f'{quote(source)}::{enum_type}' if source in known else None)
+    return f'({select} {where}) AS logs'
+
+
+def parquet_where(filters):
+    """
+    Return the WHERE clause selecting the filtered flows of logs_parquet,
+    with the days of the time range on its date partition column.
+    """
+    where = filter_where(filters)
+    days = []
+    if filters['start'] is not None:
+        days.append(f"date >= {date_literal(filters['start'])}")
+    if filters['end'] is not None:
+        days.append(f"date <= {date_literal(filters['end'])}")
+    return ' AND '.join([where] + days)
+
+
+# Logs read from a Parquet export
+def connect_parquet(parquet_dir):
+    """
+    Return an in-memory connection whose logs view reads the Parquet files
+    written by ingestion/duckdb_export_parquet.py to parquet_dir, partitioned
+    in source=<source>/date=<day>/ folders. logs_parquet has the partition
+    columns, logs the columns of the logs table.
+    """
+    pattern = os.path.join(parquet_dir, '**', '*.parquet')
+    if not glob.glob(pattern, recursive=True):
+        raise FileNotFoundError(f'No Parquet files in {parquet_dir}')
+    con = duckdb.connect()
+    con.execute(f'''
+        CREATE VIEW logs_parquet AS
+        SELECT * FROM read_parquet({quote(pattern)}, hive_partitioning = true,
+                                   hive_types = {{'source': VARCHAR, 'date': DATE}})
+    ''')
+    con.execute('CREATE VIEW logs AS SELECT * EXCLUDE (date) FROM logs_parquet')
+    logging.info(f'Reading logs from the Parquet files in {parquet_dir}.')
+    return con
+
+
+# Logs read from conn.log.gz files
+def connect_logs(log_dirs, sources=None):
+    """
+    Return an in-memory connection whose logs view reads the conn.*.log.gz
+    files under the given directories, the flows of each directory tagged
+    with the source at the same position, or the name of the directory.
+
+    The files are read by DuckDB's parallel JSON reader with the column
+    mapping and conversions of the bulk mode of zeek_ingest_connlog_by_source.py,
+    so the view has the columns of logs and the lines the ingester skips, those
+    that are not valid JSON, have no uid or cannot be converted, are skipped
+    too, but uids are not deduplicated.
+    """
+    # The column mapping and IP address macros are the ones of the ingester
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ingestion'))
+    from zeek_ingest_connlog_by_source import create_macros, read_json_sql, conversion_sql
+
+    sources = sources or [os.path.basename(os.path.normpath(log_dir)) for log_dir in log_dirs]
+    casts, converts, _ = conversion_sql()
+    selects = []
+    for log_dir, source in zip(log_dirs, sources):
+        pattern = os.path.join(log_dir, '**', 'conn.*.log.gz')
+        if not glob.glob(pattern, recursive=True):
+            raise FileNotFoundError(f'No conn.*.log.gz files in {log_dir}')
+        selects.append(f'''
+            SELECT {casts}, {quote(source)} AS source, ip_family("id.orig_h", "id.resp_h") AS ip_family
+            FROM {read_json_sql(pattern)} WHERE {converts}
+        ''')
+    con = duckdb.connect()
+    create_macros(con)
+    con.execute('CREATE VIEW logs AS ' + ' UNION ALL '.join(selects))
+    logging.info(f'Reading logs from {", ".join(log_dirs)}.')
+    return con
+
+
+# Rollups
+def has_rollups(con):
+    """Check whether the database has the flow_rollup table."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'flow_rollup'").fetchone()[0] > 0
+
+
+def rollup_query(where=''):
+    """Return the query aggregating logs at the grain of the flow_rollup table."""
+    columns = [ROLLUP_HOUR.format('ts') + ' AS hour' if key == 'hour' else key for key in ROLLUP_KEYS]
+    columns += [f'{expression} AS {name}' for name, (expression, _) in AGGREGATES.items()]
+    return f'SELECT {", ".join(columns)} FROM logs {where} GROUP BY ALL'
+
+
+def sketch_query(where=''):
+    """Return the query building the ip_sketches registers of each source and day from logs."""
+    suffix_bits = 64 - SKETCH_PRECISION
+    return f'''
+        SELECT source, day, (ip_hash >> {suffix_bits})::USMALLINT AS register,
+               MAX(CASE WHEN ip_hash & {2 ** suffix_bits - 1} = 0 THEN {suffix_bits + 1}
+                   ELSE bit_position('1'::BIT, (ip_hash & {2 ** suffix_bits - 1})::BIT) - {SKETCH_PRECISION}
+                   END)::UTINYINT AS rho
+        FROM (SELECT source, {SKETCH_DAY.format('ts')} AS day, md5_number_lower(id_orig_h) AS ip_hash
+              FROM logs {where}) AS hashes
+        WHERE ip_hash IS NOT NULL
+        GROUP BY ALL
+    '''
+
+
+def build_rollups(con):
+    """
+    Create the flow_rollup and ip_sketches tables from all of logs, replacing
+    existing ones.
+
+    The rollup_dirty table created with them is where the ingestion and
+    cleaning tools record the source and time range of flows they add or
+    delete, so refresh_rollups only recomputes the hours and days that changed.
+    """
+    con.execute('BEGIN TRANSACTION')
+    con.execute(f'CREATE OR REPLACE TABLE flow_rollup AS {rollup_query()}')
+    con.execute(f'CREATE OR REPLACE TABLE ip_sketches AS {sketch_query()}')
+    con.execute('CREATE OR REPLACE TABLE rollup_dirty (source STRING, ts_min DOUBLE, ts_max DOUBLE)')
+    con.execute('COMMIT')
+    rows = con.execute('SELECT COUNT(*) FROM flow_rollup').fetchone()[0]
+    days = con.execute('SELECT COUNT(*) FROM (SELECT DISTINCT source, day FROM ip_sketches)').fetchone()[0]
+    logging.info(f'Built flow_rollup with {rows} rows and ip_sketches for {days} source days.')
+    print(f"Built flow_rollup with {rows} rows and ip_sketches for {days} source days.")
+
+
+def drop_rollups(con):
+    """Drop the flow_rollup and ip_sketches tables, metrics are computed from logs again."""
+    con.execute('DROP TABLE IF EXISTS flow_rollup')
+    con.execute('DROP TABLE IF EXISTS ip_sketches')
+    con.execute('DROP TABLE IF EXISTS rollup_dirty')
+    logging.info('Dropped flow_rollup and ip_sketches.')
+    print("Dropped flow_rollup and ip_sketches.")
+
+
+def has_sketches(con):
+    """Check whether the database has the ip_sketches table."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'ip_sketches'").fetchone()[0] > 0
+
+
+def create_sketch_macros(con):
+    """
+    Create the hll_estimate macro, estimating the number of distinct IPs from
+    the list of non-empty registers of a merged sketch.
+    """
+    m = SKETCH_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = f'{alpha * m * m} / ({m} - len(rhos) + COALESCE(list_sum(list_transform(rhos, r -> pow(0.5, r))), 0))'
+    # Linear counting is more accurate for small counts
+    con.execute(f'''
+        CREATE OR REPLACE MACRO {SCRATCH}.main.hll_estimate(rhos) AS
+            round(CASE WHEN {raw} <= {2.5 * m} AND len(rhos) < {m} THEN {m} * ln({m} / ({m} - len(rhos)))
+                  ELSE {raw} END)::BIGINT
+    ''')
+
+
+def refresh_rollups(con):
+    """
+    Recompute the flow_rollup rows and ip_sketches of the hours and days
+    recorded in rollup_dirty.
+
+    Every (source, hour) touched by a recorded time range is deleted from the
+    rollup and aggregated again from logs, and so is every (source, day) from
+    the sketches, in one transaction. Sketch registers only keep maxima, so
+    flows deleted from logs can only be removed by rebuilding their days.
+    """
+    if not con.execute('SELECT COUNT(*) FROM rollup_dirty').fetchone()[0]:
+        return
+    hours = ('generate_series(' + ROLLUP_HOUR.format('ts_min') + ', '
+             + ROLLUP_HOUR.format('ts_max') + ', INTERVAL 1 HOUR)')
+    con.execute('BEGIN TRANSACTION')
+    con.execute(f'''
+        CREATE OR REPLACE TEMP TABLE rollup_dirty_hours AS
+        SELECT DISTINCT source, unnest(CASE WHEN ts_min IS NULL THEN [NULL::TIMESTAMP] ELSE {hours} END) AS hour
+        FROM rollup_dirty
+    ''')
+    con.execute('''
+        DELETE FROM flow_rollup r USING rollup_dirty_hours d
+        WHERE r.source IS NOT DISTINCT FROM d.source AND r.hour IS NOT DISTINCT FROM d.hour
+    ''')
+    con.execute(f'''
+        INSERT INTO flow_rollup {rollup_query(f"""
+            WHERE EXISTS (SELECT 1 FROM rollup_dirty_hours d
+                          WHERE d.source IS NOT DISTINCT FROM logs.source
+                          AND d.hour IS NOT DISTINCT FROM {ROLLUP_HOUR.format('logs.ts')})
+        """)}
+    ''')
+    con.execute('''
+        CREATE OR REPLACE TEMP TABLE rollup_dirty_days AS
+        SELECT DISTINCT source, CAST(hour AS DATE) AS day FROM rollup_dirty_hours
+    ''')
+    con.execute('''
+        DELETE FROM ip_sketches s USING rollup_dirty_days d
+        WHERE s.source IS NOT DISTINCT FROM d.source AND s.day IS NOT DISTINCT FROM d.day
+    ''')
+    con.execute(f'''
+        INSERT INTO ip_sketches {sketch_query(f"""
+            WHERE EXISTS (SELECT 1 FROM rollup_dirty_days d
+                          WHERE d.source IS NOT DISTINCT FROM logs.source
+                          AND d.day IS NOT DISTINCT FROM {SKETCH_DAY.format('logs.ts')})
+        """)}
+    ''')
+    hours = con.execute('SELECT COUNT(*) FROM rollup_dirty_hours').fetchone()[0]
+    con.execute('DELETE FROM rollup_dirty')
+    con.execute('DROP TABLE rollup_dirty_hours')
+    con.execute('DROP TABLE rollup_dirty_days')
+    con.execute('COMMIT')
+    logging.info(f'Refreshed {hours} hours of flow_rollup.')
+
+
+# Result cache
+def open_cache(con, size=CACHE_SIZE, filters=None):
+    """
+    Create the metric_cache table if needed and drop the results computed for
+    other contents of logs. Return the cache to pass to render_metric: the
+    fingerprint of logs, the size bound in bytes and the filters of the flows
+    the metrics are computed from, part of the key of their results.
+
+    The fingerprint is the row count of logs and the generation counter in
+    logs_generation, which the ingestion and cleaning tools increment whenever
+    they add or delete flows, so a cached result is never served for data that
+    changed since it was computed.
+    """
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS metric_cache (
+            metric STRING, params STRING, fingerprint STRING, result BLOB, size BIGINT, last_used TIMESTAMP,
+            PRIMARY KEY (metric, params))
+    ''')
+    con.execute('CREATE TABLE IF NOT EXISTS logs_generation (generation BIGINT)')
+    if not con.execute('SELECT COUNT(*) FROM logs_generation').fetchone()[0]:
+        con.execute('INSERT INTO logs_generation VALUES (0)')
+    rows = con.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+    generation = con.execute('SELECT MAX(generation) FROM logs_generation').fetchone()[0]
+    fingerprint = f'{rows}:{generation}'
+    stale = con.execute('DELETE FROM metric_cache WHERE fingerprint <> ?', [fingerprint]).fetchone()[0]
+    if stale:
+        logging.info(f'Dropped {stale} cached results of earlier contents of logs.')
+    return fingerprint, size * 2**20, filters
+
+
+def clear_cache(con):
+    """Drop the metric_cache table."""
+    con.execute('DROP TABLE IF EXISTS metric_cache')
+    logging.info('Dropped metric_cache.')
+    print("Dropped metric_cache.")
+
+
+def cache_params(name, approx=False, filters=None, **params):
+    """Return the cache key of the parameters and filters of a metric, including the default parameters."""
+    key = {**METRICS[name].get('params', {}), **params, 'approx': approx}
+    if filters is not None:
+        key['filters'] = filters
+    return json.dumps(key, sort_keys=True, default=str)
+
+
+def encode_result(name, result):
+    """
+    Return the result of a metric as JSON bytes, tables with their column
+    types. Results are stored as data rather than pickled, so that a shared
+    database cannot run code when its cache is read. Returns None for a
+    result with values JSON cannot hold, which is then not cached.
+    """
+    if METRICS[name]['output'] == 'table':
+        return result.to_json(orient='table', index=False).encode()
+    try:
+        return json.dumps(result).encode()
+    except TypeError:
+        return None
+
+
+def decode_result(name, blob):
+    """Return the result of a metric from the JSON bytes of encode_result."""
+    text = bytes(blob).decode()
+    if METRICS[name]['output'] == 'table':
+        return pandas.read_json(StringIO(text), orient='table')
+    result = json.loads(text)
+    if METRICS[name]['output'] == 'rows':
+        return [tuple(row) for row in result]
+    return result
+
+
+def cache_get(con, cache, name, approx=False, **params):
+    """Return whether metric_cache holds the result of a metric, and the result."""
+    fingerprint, _, filters = cache
+    key = cache_params(name, approx, filters, **params)
+    row = con.execute('SELECT result FROM metric_cache WHERE metric = ? AND params = ? AND fingerprint = ?',
+                      [name, key, fingerprint]).fetchone()
+    if row is None:
+        return False, None
+    try:
+        result = decode_result(name, row[0])
+    except Exception as e:
+        # Results stored by earlier versions of this tool are not JSON
+        logging.warning(f'Ignoring cached result of {name}: {e}')
+        return False, None
+    con.execute('UPDATE metric_cache SET last_used = now() WHERE metric = ? AND params = ?', [name, key])
+    logging.debug(f'Cache hit for {name} {key}')
+    return True, result
+
+
+def cache_put(con, cache, name, result, approx=False, **params):
+    """
+    Store the result of a metric in metric_cache, then evict the least
+    recently used results until the cache fits in its size bound.
+    """
+    fingerprint, size, filters = cache
+    blob = encode_result(name, result)
+    if blob is None or len(blob) > size:
+        return
+    con.execute('INSERT OR REPLACE INTO metric_cache VALUES (?, ?, ?, ?, ?, now())',
+                [name, cache_params(name, approx, filters, **params), fingerprint, blob, len(blob)])
+    evicted = con.execute('''
+        DELETE FROM metric_cache WHERE (metric, params) IN (
+            SELECT (metric, params) FROM (
+                SELECT metric, params, SUM(size) OVER (ORDER BY last_used DESC, metric, params) AS total
+                FROM metric_cache)
+            WHERE total > ?)
+    ''', [size]).fetchone()[0]
+    if evicted:
+        logging.info(f'Evicted {evicted} results from metric_cache.')
+
+
+def cached_metrics(con, cache, names, approx=False):
+    """Return the names of the metrics whose results are in metric_cache."""
+    fingerprint, _, filters = cache
+    return {name for name in names
+            if con.execute('SELECT COUNT(*) FROM metric_cache WHERE metric = ? AND params = ? AND fingerprint = ?',
+                           [name, cache_params(name, approx, filters), fingerprint]).fetchone()[0]}
+
+
+# Metrics engine
+def metric_keys(names):
+    """
+    Return the flow_totals keys and aggregates, and the source_ips keys, the
+    given metrics need. The keys are None when no metric uses that table.
+    """
+    keys, aggregates, distinct_keys = None, set(), None
+    for name in names:
+        metric = METRICS[name]
+        if 'keys' in metric:
+            keys = (keys or set()) | set(metric['keys'])
+            aggregates |= set(metric['aggregates'])
+        if 'distinct_keys' in metric:
+            distinct_keys = (distinct_keys or set()) | set(metric['distinct_keys'])
+    return keys, aggregates, distinct_keys
+
+
+def attach_scratch(con):
+    """Attach the metrics_scratch database to the connection and look tables up in it after main."""
+    if not con.execute('SELECT COUNT(*) FROM duckdb_databases() WHERE database_name = ?', [SCRATCH]).fetchone()[0]:
+        con.execute(f"ATTACH ':memory:' AS {SCRATCH}")
+    con.execute(f"SET search_path = 'main,{SCRATCH}.main'")
+
+
+def metric_cursor(con):
+    """Return a new cursor of the connection that sees the tables of metrics_scratch."""
+    cursor = con.cursor()
+    cursor.execute(f"SET search_path = 'main,{SCRATCH}.main'")
+    return cursor
+
+
+def default_jobs(con):
+    """Return the default number of concurrent queries, the number of DuckDB threads."""
+    return con.execute("SELECT current_setting('threads')").fetchone()[0]
+
+
+def run_parallel(con, tasks, jobs=1):
+    """
+    Run tasks, functions of a cursor, on a pool of up to jobs cursors of the
+    connection and return their results in the order of the tasks.
+
+    All cursors share the database instance of the connection, so the
+    queries together use at most its threads and memory_limit settings.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return [task(con) for task in tasks]
+    local = threading.local()
+    cursors = []
+
+    def run(task):
+        if not hasattr(local, 'cursor'):
+            local.cursor = metric_cursor(con)
+            cursors.append(local.cursor)
+        return task(local.cursor)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            return list(pool.map(run, tasks))
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+
+# Output files
+def export_query(name, approx=False, **params):
+    """Return the query of a metric as written to a file, with single values in a column named after the metric."""
+    query = metric_query(name, approx, **params)
+    if METRICS[name]['output'] == 'value':
+        return f'SELECT * FROM ({query}) AS result({name})'
+    return query
+
+
+def write_metrics(con, names, output_dir, output_format='csv', approx=False, jobs=1, profile=None, filters=None,
+                  **params):
+    """
+    Write the result of each metric from the tables computed by
+    prepare_metrics to <output_dir>/<metric>.<format> with COPY, up to jobs
+    metrics at a time, and list the files in <output_dir>/manifest.json.
+
+    Results go from DuckDB straight to the files, they are never loaded into
+    Python. A metric whose query fails is listed in the manifest with its
+    error instead of a file.
+    """
+    extension, options = OUTPUT_FORMATS[output_format]
+    os.makedirs(output_dir, exist_ok=True)
+    names = list(dict.fromkeys(names))
+
+    def copy(name):
+        path = os.path.join(output_dir, f'{name}.{extension}')
+
+        def task(cursor):
+            try:
+                query = export_query(name, approx, **params)
+                rows = cursor.execute(f"COPY ({query}) TO '{path.replace(chr(39), chr(39) * 2)}' ({options})").fetchone()[0]
+            except duckdb.Error as e:
+                if 'error' not in METRICS[name]:
+                    raise
+                return e
+            return {'metric': name, 'file': os.path.basename(path), 'rows': rows}
+        return task
+
+    files = []
+    for name, result in zip(names, run_parallel(con, [profiled(copy(name), name, profile) for name in names], jobs)):
+        if isinstance(result, duckdb.Error):
+            print(f"{METRICS[name]['error']}: {result}")
+            files.append({'metric': name, 'error': str(result)})
+        else:
+            files.append(result)
+    manifest = {
+        'format': output_format,
+        'approx': approx,
+        'params': {name: {**METRICS[name]['params'], **params} for name in names if 'params' in METRICS[name]},
+        'filters': filters,
+        'files': files,
+    }
+    if approx:
+        manifest['approx_standard_error'] = SKETCH_ERROR
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    written = sum(1 for entry in files if 'file' in entry)
+    logging.info(f'Wrote {written} metric files to {output_dir}.')
+    print(f"Wrote {written} {output_format} files and manifest.json to {output_dir}")
+
+
+# Profiling
+def profiled(task, name, profile):
+    """
+    Wrap a task running one query so that the wall time, rows scanned, peak
+    buffer memory and DuckDB query profile of the query are appended to the
+    profile list. Without a profile list the task is returned as is.
+    """
+    if profile is None:
+        return task
+
+    def run(cursor):
+        cursor.execute("SET enable_profiling = 'no_output'")
+        cursor.execute("SET profiling_mode = 'detailed'")
+        start = time.perf_counter()
+        try:
+            result = task(cursor)
+        except duckdb.Error as e:
+            profile.append({'name': name, 'wall_time': time.perf_counter() - start, 'error': str(e)})
+            raise
+        entry = {'name': name, 'wall_time': time.perf_counter() - start}
+        if isinstance(result, duckdb.Error):
+            entry['error'] = str(result)
+        else:
+            details = json.loads(cursor.get_profiling_information(format='json'))
+            entry['rows_scanned'] = details.get('cumulative_rows_scanned')
+            entry['peak_memory'] = details.get('system_peak_buffer_memory')
+            entry['profile'] = details
+        profile.append(entry)
+        return result
+
+    return run
+
+
+def slowest_operators(profile, top=PROFILE_TOP):
+    """Return the operators of all profiled queries with the longest time, slowest first."""
+    operators = []
+
+    def walk(query, node):
+        for child in node.get('children', []):
+            operators.append({
+                'query': query,
+                'operator': child.get('operator_name'),
+                'time': child.get('operator_timing') or 0,
+                'rows': child.get('operator_cardinality'),
+                'rows_scanned': child.get('operator_rows_scanned'),
+            })
+            walk(query, child)
+
+    for entry in profile:
+        if 'profile' in entry:
+            walk(entry['name'], entry['profile'])
+    return sorted(operators, key=lambda operator: operator['time'], reverse=True)[:top]
+
+
+def write_profile(con, profile, file_path, wall_time, jobs):
+    """Write the --profile report as JSON and print the slowest queries and operators."""
+    threads, memory_limit = con.execute(
+        "SELECT current_setting('threads'), current_setting('memory_limit')").fetchone()
+    operators = slowest_operators(profile)
+    report = {
+        'wall_time': wall_time,
+        'jobs': jobs,
+        'threads': threads,
+        'memory_limit': memory_limit,
+        'queries': profile,
+        'slowest_operators': operators,
+    }
+    with open(file_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logging.info(f'Wrote the query profile to {file_path}.')
+
+    print(f"Profile of {len(profile)} queries written to {file_path}, total time {wall_time:.3f}s")
+    print(f"{'Query':<32} {'Time (s)':>10} {'Rows scanned':>14} {'Peak memory (MiB)':>18}")
+    for entry in sorted(profile, key=lambda entry: entry['wall_time'], reverse=True):
+        if 'error' in entry:
+            print(f"{entry['name']:<32} {entry['wall_time']:>10.3f}  {entry['error']}")
+        else:
+            print(f"{entry['name']:<32} {entry['wall_time']:>10.3f} {entry['rows_scanned'] or 0:>14} "
+                  f"{(entry['peak_memory'] or 0) / 2**20:>18.1f}")
+    print("Slowest operators:")
+    print(f"{'Query':<32} {'Operator':<24} {'Time (s)':>10} {'Rows':>12}")
+    for operator in operators:
+        print(f"{operator['query']:<32} {operator['operator']:<24} {operator['time']:>10.3f} {operator['rows'] or 0:>12}")
+
+
+def prepare_metrics(con, names, rollups=True, approx=False, jobs=1, profile=None, filters=None, single_pass=False):
+    """
+    Compute the tables the given metrics are answered from.
+
+    All additive aggregates are computed in a single scan into the flow_totals
+    table, grouped by the union of the keys of the metrics. The scan is over
+    flow_rollup when the database has one, after refreshing the hours that
+    changed, and over logs otherwise. Distinct source IP counts cannot be
+    added up over groups, so the distinct source IPs are collected in a second
+    scan of logs into source_ips, only if a metric needs them. With approx,
+    they are estimated from ip_sketches instead and no second scan is needed.
+    Both tables are in metrics_scratch, and with jobs > 1 the two scans run
+    concurrently. With a profile list, the profile of each scan is recorded in
+    it (see profiled).
+
+    With filters (see make_filters), only the selected flows are scanned.
+    flow_rollup is used only when the time range is in whole hours, and
+    ip_sketches must be used with a time range in whole days.
+
+    With single_pass, when both tables are computed from logs, the columns
+    they need are first copied into a flows table in metrics_scratch and both
+    are computed from it, so that logs is read once. This is for logs that
+    are expensive to read, like the view over gzipped logs of connect_logs.
+    """
+    attach_scratch(con)
+    keys, aggregates, distinct_keys = metric_keys(names)
+    use_rollups = rollups and has_rollups(con)
+    if use_rollups and keys is not None and not aligned(filters, 'hour'):
+        logging.info('The time range is not in whole hours, computing flow_totals from logs instead of flow_rollup.')
+        use_rollups = False
+    if (use_rollups and keys is not None) or (approx and distinct_keys is not None):
+        refresh_rollups(con)
+    logs = logs_relation(con, filters)
+    if single_pass and keys is not None and not use_rollups and distinct_keys is not None and not approx:
+        columns = FLOW_KEYS + ['id_orig_h', 'orig_bytes', 'resp_bytes', 'orig_pkts', 'resp_pkts']
+        run_parallel(con, [profiled(lambda cursor: cursor.execute(
+            f'CREATE OR REPLACE TABLE {SCRATCH}.flows AS SELECT {", ".join(columns)} FROM {logs}').fetchall(),
+            'flows', profile)])
+        logs = f'{SCRATCH}.flows'
+    queries = []
+    if keys is not None:
+        columns = [key for key in FLOW_KEYS if key in keys]
+        if use_rollups:
+            columns += [f'{merge} AS {name}' for name, (_, merge) in AGGREGATES.items() if name in aggregates]
+            relation = f"flow_rollup {filter_where(filters, 'hour', timestamp_literal)}"
+        else:
+            columns += [f'{expression} AS {name}' for name, (expression, _) in AGGREGATES.items() if name in aggregates]
+            relation = logs
+        queries.append(('flow_totals', f'CREATE OR REPLACE TABLE {SCRATCH}.flow_totals AS '
+                                       f'SELECT {", ".join(columns)} FROM {relation} GROUP BY ALL'))
+        logging.debug(f'Computing flow_totals from {relation}: {", ".join(columns)}')
+    if distinct_keys is not None and approx:
+        create_sketch_macros(con)
+        queries.append(('source_sketches', f'CREATE OR REPLACE TABLE {SCRATCH}.source_sketches AS '
+                                           f'SELECT source, register, MAX(rho) AS rho FROM ip_sketches '
+                                           f"{filter_where(filters, 'day', date_literal)} GROUP BY ALL"))
+    elif distinct_keys is not None:
+        columns = [key for key in FLOW_KEYS if key in distinct_keys] + ['id_orig_h']
+        queries.append(('source_ips', f'CREATE OR REPLACE TABLE {SCRATCH}.source_ips AS '
+                                      f'SELECT {", ".join(columns)} FROM {logs} GROUP BY ALL'))
+        logging.debug(f'Computing source_ips: {", ".join(columns)}')
+
+    def create(query):
+        return lambda cursor: cursor.execute(query).fetchall()
+
+    run_parallel(con, [profiled(create(query), name, profile) for name, query in queries], jobs)
+
+
+def metric_query(name, approx=False, **params):
+    """Return the query of a metric with its parameters filled in."""
+    metric = METRICS[name]
+    query = metric['approx_query'] if approx and 'approx_query' in metric else metric['query']
+    return query.format(**{**metric.get('params', {}), **params})
+
+
+def fetch_metric(con, name, approx=False, **params):
+    """Run the query of a metric on the tables computed by prepare_metrics and return its result."""
+    metric = METRICS[name]
+    query = metric_query(name, approx, **params)
+    if metric['output'] == 'value':
+        return con.execute(query).fetchone()[0]
+    if metric['output'] == 'rows':
+        return con.execute(query).fetchall()
+    return con.execute(query).fetchdf()
+
+
+def print_metric(name, result):
+    """Print the result of a metric, or its error message if its query failed."""
+    metric = METRICS[name]
+    if isinstance(result, duckdb.Error):
+        print(f"{metric['error']}: {result}")
+        return
+    if metric['output'] == 'value':
+        print(metric['format'].format(result))
+    elif metric['output'] == 'rows':
+        print(metric['title'])
+        for row in result:
+            print(metric['format'].format(*row))
+    else:
+        if 'title' in metric:
+            print(metric['title'])
+        print(result)
+    if metric.get('blank_line'):
+        print()
+
+
+def collect_metrics(con, names, approx=False, cache=None, jobs=1, profile=None, **params):
+    """
+    Return the results of the given metrics by name, from metric_cache when
+    it holds them for the current logs (see render_metric for the cache) and
+    otherwise queried from the tables computed by prepare_metrics, up to jobs
+    metrics at a time. The result of a metric with an error message whose
+    query fails is the duckdb.Error. With a profile list, the profile of each
+    query is recorded in it (see profiled).
+    """
+    results = {}
+    if cache is not None:
+        for name in names:
+            found, result = cache_get(con, cache, name, approx, **params)
+            if found:
+                results[name] = result
+    pending = [name for name in dict.fromkeys(names) if name not in results]
+
+    def fetch(name):
+        def task(cursor):
+            try:
+                return fetch_metric(cursor, name, approx, **params)
+            except duckdb.Error as e:
+                if 'error' not in METRICS[name]:
+                    raise
+                return e
+        return task
+
+    for name, result in zip(pending, run_parallel(con, [profiled(fetch(name), name, profile) for name in pending], jobs)):
+        results[name] = result
+        if cache is not None and not isinstance(result, duckdb.Error):
+            cache_put(con, cache, name, result, approx, **params)
+    return results
+
+
+def render_metric(con, name, approx=False, cache=None, **params):
+    """
+    Print a metric, from metric_cache when it holds a result for the current
+    logs and from the tables computed by prepare_metrics otherwise. The cache
+    is the one returned by open_cache, None to bypass it.
+    """
+    print_metric(name, collect_metrics(con, [name], approx, cache, **params)[name])
+
+
+def run_metrics(con, names, approx=False, **params):
+    """Compute the given metrics in as few scans of logs as possible and print them."""
+    prepare_metrics(con, names, approx=approx)
+    results = collect_metrics(con, names, approx, **params)
+    for name in names:
+        print_metric(name, results[name])
+
+
 # Feature Extraction
 def total_bytes(con):
     """
@@ -39,13 +1160,7 @@ def total_bytes(con):
         - Total Bytes = orig_bytes + resp_bytes
         - Use BIGINT for variable
     """
-
-    result = con.execute(
-        "SELECT SUM(CAST(orig_bytes AS BIGINT) + CAST(resp_bytes AS BIGINT)) FROM logs;"
-    ).fetchone()[0]
-
-    print(f"Total bytes: {result}")
-    print()
+    run_metrics(con, ['total_bytes'])
 
 
 def total_packets(con):
@@ -54,13 +1169,7 @@ def total_packets(con):
         - Total Packets = orig_pkts + resp_pkts
         - Use BIGINT for variable
     """
-
-    result = con.execute(
-        "SELECT SUM(CAST(orig_pkts AS BIGINT) + CAST(resp_pkts AS BIGINT)) FROM logs;"
-    ).fetchone()[0]
-
-    print(f"Total packets: {result}")
-    print()
+    run_metrics(con, ['total_packets'])
 
 
 def total_flows(con):
@@ -69,62 +1178,27 @@ def total_flows(con):
         - Dataset is the table 'logs'
         - Flows will be one per row
     """
-
-    result = con.execute(
-        "SELECT COUNT(*) FROM logs;"
-    ).fetchone()[0]
-
-    print(f"Total flows: {result}")
-    print()
+    run_metrics(con, ['total_flows'])
 
 
 def total_flows_ipv4(con):
     """
     Calculate the total number of IPv4 flows in the DuckDB database.
 
-    IPv4 Flows: Rows where both id_orig_h and id_resp_h are valid IPv4 addresses.
+    IPv4 Flows: Rows where both id_orig_h and id_resp_h are valid IPv4 addresses,
+    as classified at ingest time in the ip_family column.
     """
-    try:
-        # SQL query to filter and count rows with valid IPv4 addresses using regex
-        result = con.execute('''
-            SELECT COUNT(*)
-            FROM logs
-            WHERE 
-                regexp_matches(id_orig_h, '^((\\d{1,3}.){3}\\d{1,3})$')
-            AND 
-                regexp_matches(id_resp_h, '^((\\d{1,3}.){3}\\d{1,3})$')
-        ''').fetchone()[0]
-
-        print(f'Total IPv4 flows calculated: {result}')
-        print()
-
-    except Exception as e:
-        print(f"Error calculating IPv4 flows: {e}")
-        return None
+    run_metrics(con, ['total_flows_ipv4'])
 
 
 def total_flows_ipv6(con):
     """
     Calculate the total number of IPv6 flows in the DuckDB database.
 
-    IPv6 Flows: Rows where both id_orig_h and id_resp_h are valid IPv6 addresses.
+    IPv6 Flows: Rows where both id_orig_h and id_resp_h are valid IPv6 addresses,
+    as classified at ingest time in the ip_family column.
     """
-    try:
-        # SQL query to filter and count rows with valid IPv6 addresses using regex
-        result = con.execute('''
-            SELECT COUNT(*)
-            FROM logs
-            WHERE NOT 
-                regexp_matches(id_orig_h, '^((\\d{1,3}.){3}\\d{1,3})$')
-            AND NOT
-                regexp_matches(id_resp_h, '^((\\d{1,3}.){3}\\d{1,3})$')
-        ''').fetchone()[0]
-
-        print(f'Total IPv6 flows calculated: {result}')
-
-    except Exception as e:
-        print(f"Error calculating IPv6 flows: {e}")
-        return None
+    run_metrics(con, ['total_flows_ipv6'])
 
 
 def protocol_summary(con):
@@ -132,135 +1206,44 @@ def protocol_summary(con):
     Outputs the number of flows in total, the number of flows using TCP, UDP, and ICMP,
     grouped by IPv4 and IPv6.
     """
-    try:
-        # Query to calculate flows grouped by IP type (IPv4/IPv6) and protocol
-        query = '''
-            SELECT
-                CASE
-                    WHEN regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$')
-                         AND regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$')
-                    THEN 'IPv4'
-                    ELSE 'IPv6'
-                END AS "IP Proto",
-                COUNT(*) AS "Total Flows",
-                SUM(CASE WHEN proto = 'tcp' THEN 1 ELSE 0 END) AS "TCP Flows",
-                SUM(CASE WHEN proto = 'udp' THEN 1 ELSE 0 END) AS "UDP Flows",
-                SUM(CASE WHEN proto = 'icmp' THEN 1 ELSE 0 END) AS "ICMP Flows"
-            FROM logs
-            GROUP BY "IP Proto";
-        '''
-
-        # Execute the query and fetch the result as a Pandas DataFrame
-        result_df = con.execute(query).fetchdf()
-
-        print("Total flows grouped by IPv4/IPv6 and protocol):")
-        print(result_df)
-
-    except Exception as e:
-        print(f"Error generating protocol summary: {e}")
-        return None
+    run_metrics(con, ['protocol_summary'])
 
 
 def flows_by_protocol_and_source(con):
     """
     Calculate the total number of flows by honeypot source, with a distinction between
     IPv4 and IPv6 flows, and output in a CSV-friendly format.
+        - IPv4/IPv6 is the ip_family column classified at ingest time
     """
-    try:
-        # Query to calculate the required data
-        query = '''
-            SELECT
-                source as "Honeypot Name (Source)",
-                COUNT(*) AS total_flows,
-                SUM(CASE WHEN regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                              regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv4_flows,
-                SUM(CASE WHEN NOT regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                              NOT regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv6_flows,
-                SUM(CASE WHEN proto = 'tcp' THEN 1 ELSE 0 END) AS total_tcp_flows,
-                SUM(CASE WHEN proto = 'udp' THEN 1 ELSE 0 END) AS total_udp_flows,
-                SUM(CASE WHEN proto = 'icmp' THEN 1 ELSE 0 END) AS total_icmp_flows,
-                SUM(CASE WHEN proto = 'tcp' AND regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                         regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv4_tcp_flows,
-                SUM(CASE WHEN proto = 'udp' AND regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                         regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv4_udp_flows,
-                SUM(CASE WHEN proto = 'icmp' AND regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                          regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv4_icmp_flows,
-                SUM(CASE WHEN proto = 'tcp' AND NOT regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                         NOT regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv6_tcp_flows,
-                SUM(CASE WHEN proto = 'udp' AND NOT regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                         NOT regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv6_udp_flows,
-                SUM(CASE WHEN proto = 'icmp' AND NOT regexp_matches(id_orig_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') AND
-                                          NOT regexp_matches(id_resp_h, '^((\\d{1,3}\\.){3}\\d{1,3})$') THEN 1 ELSE 0 END) AS ipv6_icmp_flows
-            FROM logs
-            GROUP BY "Honeypot Name (Source)"
-            ORDER BY "Honeypot Name (Source)";
-        '''
-
-        # Execute the query
-        result_df = con.execute(query).fetchdf()
-
-        print(result_df)
-    except Exception as e:
-        print(f"Error calculating flows by protocol and source: {e}")
+    run_metrics(con, ['flows_by_protocol_and_source'])
 
 
 def packets_per_honeypot_source(con):
     """
     Calculate the amount of packets per honeypot location source.
     """
+    run_metrics(con, ['packets_per_honeypot_source'])
 
-    result = con.execute(
-        "SELECT source, SUM(orig_pkts + resp_pkts) as packet_count FROM logs GROUP BY source;"
-    ).fetchall()
-
-    print("Amount of packets per honeypot location source:")
-
-    for row in result:
-        print(f"Source: {row[0]}, Packet Count: {row[1]}")
-
-    print()
 
 def bytes_per_honeypot_source(con):
     """
     Calculate the amount of bytes per honeypot location source.
     """
+    run_metrics(con, ['bytes_per_honeypot_source'])
 
-    result = con.execute(
-        "SELECT source, SUM(CAST(orig_bytes AS BIGINT) + CAST(resp_bytes AS BIGINT)) as byte_count FROM logs GROUP BY source;"
-    ).fetchall()
-
-    print("Amount of bytes per honeypot location source:")
-    for row in result:
-        print(f"Source: {row[0]}, Byte Count: {row[1]}")
-
-    print()
 
 def flows_per_honeypot_source(con):
     """
     Calculate the amount of flows per honeypot location source.
     """
+    run_metrics(con, ['flows_per_honeypot_source'])
 
-    result = con.execute(
-        "SELECT source, COUNT(*) as flow_count FROM logs GROUP BY source;"
-    ).fetchall()
-
-    print("Amount of flows per honeypot location source:")
-    for row in result:
-        print(f"Source: {row[0]}, Flow Count: {row[1]}")
-
-    print()
 
 def unique_source_ips(con):
     """
     Calculate the total unique source IP addresses.
     """
-
-    result = con.execute(
-        "SELECT COUNT(DISTINCT id_orig_h) as unique_ips FROM logs;"
-    ).fetchone()[0]
-
-    print(f"Total unique source IP addresses: {result}")
-    print()
+    run_metrics(con, ['unique_source_ips'])
 
 
 def unique_source_ips_per_honeypot(con):
@@ -268,17 +1251,7 @@ def unique_source_ips_per_honeypot(con):
     Calculate the total unique source IP addresses per honeypot
     location source.
     """
-
-    result = con.execute(
-        "SELECT source, COUNT(DISTINCT id_orig_h) as unique_ips FROM logs GROUP BY source;"
-    ).fetchall()
-
-    print("Total unique source IP addresses per honeypot location source:")
-
-    for row in result:
-        print(f"Source: {row[0]}, Unique IPs: {row[1]}")
-
-    print()
+    run_metrics(con, ['unique_source_ips_per_honeypot'])
 
 
 def generate_honeypot_summary_csv(con):
@@ -290,79 +1263,21 @@ def generate_honeypot_summary_csv(con):
     - Total Number of Bytes
     - Total Number of Packets
     """
-    try:
-        # SQL query to calculate the required metrics
-        query = """
-        SELECT 
-            source AS "Honeypot Name (Source)",
-            COUNT(*) AS "Total Number of Network Flows",
-            COUNT(DISTINCT id_orig_h) AS "Total Number of Unique Src IPs",
-            SUM(orig_bytes + resp_bytes) AS "Total Number of Bytes",
-            SUM(orig_pkts + resp_pkts) AS "Total Number of Packets"
-        FROM logs
-        GROUP BY source
-        ORDER BY source;
-        """
-
-        # Execute query and fetch results
-        result_df = con.execute(query).fetchdf()
-
-        print(result_df)
+    run_metrics(con, ['honeypot_summary'])
 
-    except Exception as e:
-        print(f"Error generating honeypot summary: {e}")
 
 def total_flows_per_destination_port_udp(con, top_n=10):
     """
     Get the total flows per destination port (id_resp_p) and return the top N ports.
     """
-    try:
-        # SQL query to calculate flows per destination port
-        query = f"""
-        SELECT 
-            id_resp_p AS "UDP Port",
-            COUNT(*) AS "Total Network Flows"
-        FROM logs
-        WHERE proto = 'udp'
-        GROUP BY id_resp_p
-        ORDER BY "Total Network Flows" DESC
-        LIMIT {top_n};
-        """
-
-        # Execute query and fetch the result
-        result_df = con.execute(query).fetchdf()
-
-        # Print results
-        print(result_df)
-    except Exception as e:
-        print(f"Error calculating flows per destination port: {e}")
-        return None
+    run_metrics(con, ['top_udp_ports'], top_n=top_n)
+
 
 def total_flows_per_destination_port_tcp(con, top_n=10):
     """
     Get the total flows per destination port (id_resp_p) and return the top N ports.
     """
-    try:
-        # SQL query to calculate flows per destination port
-        query = f"""
-        SELECT 
-            id_resp_p AS "TCP Port",
-            COUNT(*) AS "Total Network Flows"
-        FROM logs
-        WHERE proto = 'tcp'
-        GROUP BY id_resp_p
-        ORDER BY "Total Network Flows" DESC
-        LIMIT {top_n};
-        """
-
-        # Execute query and fetch the result
-        result_df = con.execute(query).fetchdf()
-
-        # Print results
-        print(result_df)
-    except Exception as e:
-        print(f"Error calculating flows per destination port: {e}")
-        return None
+    run_metrics(con, ['top_tcp_ports'], top_n=top_n)
 
 
 def main():
@@ -379,13 +1294,78 @@ def main():
                         help='Log file name (default: feature_extraction.log)')
 
     # DB
-    parser.add_argument('--db_name',
-                        required=True,
-                        help='Path to the DuckDB database file')
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument('--db_name',
+                      help='Path to the DuckDB database file')
+    data.add_argument('--log_dir',
+                      action='append',
+                      help='Compute the metrics directly from the conn.*.log.gz files in this folder instead of '
+                           'a database (can be repeated)')
+    data.add_argument('--parquet_dir',
+                      help='Compute the metrics from the Parquet export of ingestion/duckdb_export_parquet.py in '
+                           'this folder instead of a database')
+    # FILTERS
+    parser.add_argument('--source',
+                        action='append',
+                        help='Compute the metrics only from the flows of this source, or with --log_dir the source '
+                             'name of each folder in the same order (default: the folder name) (can be repeated)')
+    parser.add_argument('--start',
+                        type=parse_time,
+                        help='Compute the metrics only from flows from this UTC date or time on, e.g. 2024-05-01')
+    parser.add_argument('--end',
+                        type=parse_time,
+                        help='Compute the metrics only from flows before this UTC date or time')
     # DB INFO
     parser.add_argument('--info',
                         action='store_true',
                         help='Print general information about the database')
+    # ROLLUPS
+    parser.add_argument('--build_rollups',
+                        action='store_true',
+                        help='Build the flow_rollup table metrics are answered from, replacing an existing one')
+    parser.add_argument('--drop_rollups',
+                        action='store_true',
+                        help='Drop the flow_rollup table')
+    parser.add_argument('--approx',
+                        action='store_true',
+                        help='Estimate unique source IPs from the ip_sketches built with --build_rollups')
+    parser.add_argument('--no_rollups',
+                        action='store_true',
+                        help='Compute metrics from logs even if the database has a flow_rollup table')
+    # CACHE
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='Compute every metric, without reading or storing results in metric_cache')
+    parser.add_argument('--cache_size',
+                        type=int,
+                        default=CACHE_SIZE,
+                        help=f'Maximum size of the results kept in metric_cache, in MiB (default: {CACHE_SIZE})')
+    parser.add_argument('--clear_cache',
+                        action='store_true',
+                        help='Drop the metric_cache table')
+    # PARALLELISM
+    parser.add_argument('--jobs',
+                        type=int,
+                        help='Number of metric queries run concurrently (default: the number of DuckDB threads)')
+    parser.add_argument('--threads',
+                        type=int,
+                        help='Number of threads DuckDB uses for all queries together (default: DuckDB default)')
+    parser.add_argument('--memory_limit',
+                        help='Memory limit of DuckDB for all queries together, for example 8GB (default: DuckDB default)')
+    # OUTPUT FILES
+    parser.add_argument('--output_dir',
+                        help='Write each metric to a file in this directory instead of printing it')
+    parser.add_argument('--output_format',
+                        choices=sorted(OUTPUT_FORMATS),
+                        default='csv',
+                        help='Format of the files written to --output_dir (default: csv)')
+    # PROFILING
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Record the time, rows scanned, peak memory and DuckDB profile of every query')
+    parser.add_argument('--profile_file',
+                        default=PROFILE_FILE,
+                        help=f'JSON file of the --profile report (default: {PROFILE_FILE})')
     # OBTAIN ALL METRICS
     parser.add_argument('--metrics',
                         action='store_true',
@@ -439,75 +1419,94 @@ def main():
 
     logging.info('Starting feature extraction.')
 
-    con = duckdb.connect(args.db_name)
+    if args.log_dir and args.source and len(args.source) != len(args.log_dir):
+        parser.error('with --log_dir, give one --source per --log_dir')
+    if (args.log_dir or args.parquet_dir) and (args.build_rollups or args.approx):
+        parser.error('--build_rollups and --approx need a database, use --db_name')
+    if args.log_dir or args.parquet_dir:
+        try:
+            con = connect_logs(args.log_dir, args.source) if args.log_dir else connect_parquet(args.parquet_dir)
+        except FileNotFoundError as e:
+            print(e)
+            return
+    else:
+        con = duckdb.connect(args.db_name)
+    if args.threads:
+        con.execute(f'SET threads = {args.threads}')
+    if args.memory_limit:
+        con.execute(f"SET memory_limit = '{args.memory_limit}'")
+    jobs = args.jobs or default_jobs(con)
+
+    if args.clear_cache:
+        clear_cache(con)
+
+    if args.drop_rollups:
+        drop_rollups(con)
+
+    if args.build_rollups and has_ip_family(con):
+        build_rollups(con)
 
     if args.info:
         check_db_info(con)
 
-    if args.metrics:
-        print("-------------------------------------------------------------------------------------")
-        print("Table 1: CTU Hornet 65 Niner dataset metrics overview per honeypot during the 65 days")
-        print("-------------------------------------------------------------------------------------")
-        generate_honeypot_summary_csv(con)
-        print("-------------------------------------------------------------------------------------")
-        print()
-        print("-------------------------------------------------------------------------------------")
-        print("Table 2 and 3: CTU Hornet 65 Niner dataset total network flows by L3 and L4")
-        print("-------------------------------------------------------------------------------------")
-        flows_by_protocol_and_source(con)
-        print("-------------------------------------------------------------------------------------")
-        print()
-        print("-------------------------------------------------------------------------------------")
-        print("Table 4: Top 10 TCP destination ports by total number of network flows")
-        print("-------------------------------------------------------------------------------------")
-        total_flows_per_destination_port_tcp(con)
-        print("-------------------------------------------------------------------------------------")
-        print()
-        print("-------------------------------------------------------------------------------------")
-        print("Table 5: Top 10 UDP destination ports by total number of network flows")
-        print("-------------------------------------------------------------------------------------")
-        total_flows_per_destination_port_udp(con)
-        print("-------------------------------------------------------------------------------------")
-        print()
-
-    if args.total_flows:
-        total_flows(con)
-
-    if args.total_flows_ipv4:
-        total_flows_ipv4(con)
-
-    if args.total_flows_ipv6:
-        total_flows_ipv6(con)
-
-    if args.total_bytes:
-        total_bytes(con)
-
-    if args.total_packets:
-        total_packets(con)
-
-    if args.flows_by_proto_source:
-        flows_by_protocol_and_source(con)
-
-    if args.packets_per_honeypot_source:
-        packets_per_honeypot_source(con)
-
-    if args.bytes_per_honeypot_source:
-        bytes_per_honeypot_source(con)
-
-    if args.flows_per_honeypot_source:
-        flows_per_honeypot_source(con)
-
-    if args.unique_source_ips:
-        unique_source_ips(con)
-
-    if args.unique_source_ips_per_honeypot:
-        unique_source_ips_per_honeypot(con)
-    
-    if args.flows_by_top_dst_ports:
-        total_flows_per_destination_port(con)
+    names = [name for _, name in REPORT] if args.metrics else []
+    names += [name for flag, flag_names in FLAGS if getattr(args, flag) for name in flag_names]
+    keys, _, distinct_keys = metric_keys(names)
+    if keys and 'ip_family' in keys and not has_ip_family(con):
+        return
+    approx = args.approx and distinct_keys is not None
+    if approx and not has_sketches(con):
+        print("The database has no ip_sketches table. Build it with --build_rollups.")
+        return
+    filters = make_filters(None if args.log_dir else args.source, args.start, args.end)
+    if approx and not aligned(filters, 'day'):
+        print("With --approx, --start and --end must be whole days, ip_sketches has one sketch per day.")
+        return
+
+    # Files are written by DuckDB from the computed tables, and logs read from
+    # log or Parquet files have no database to keep results in
+    cache = None
+    cached = set()
+    if names and not args.no_cache and not args.output_dir and args.db_name:
+        cache = open_cache(con, args.cache_size, filters)
+        cached = cached_metrics(con, cache, names, approx)
+
+    # One pass over logs for all requested metrics not in the cache, then
+    # the metrics themselves, concurrently
+    profile = [] if args.profile else None
+    start = time.perf_counter()
+    prepare_metrics(con, [name for name in names if name not in cached], rollups=not args.no_rollups,
+                    approx=approx, jobs=jobs, profile=profile, filters=filters, single_pass=bool(args.log_dir))
+    if args.output_dir:
+        write_metrics(con, names, args.output_dir, args.output_format, approx, jobs, profile, filters)
+        wall_time = time.perf_counter() - start
+    else:
+        results = collect_metrics(con, names, approx, cache, jobs, profile)
+        wall_time = time.perf_counter() - start
+
+        if args.metrics:
+            for title, name in REPORT:
+                print("-------------------------------------------------------------------------------------")
+                print(title)
+                print("-------------------------------------------------------------------------------------")
+                print_metric(name, results[name])
+                print("-------------------------------------------------------------------------------------")
+                print()
+
+        for flag, flag_names in FLAGS:
+            if getattr(args, flag):
+                for name in flag_names:
+                    print_metric(name, results[name])
+
+    if approx:
+        print(f"Unique source IPs are estimated from HyperLogLog sketches with {SKETCH_REGISTERS} registers, "
+              f"standard error {SKETCH_ERROR:.2%}.")
+
+    if args.profile:
+        write_profile(con, profile, args.profile_file, wall_time, jobs)
 
     logging.info('Feature extraction complete.')
 
+
 if __name__ == '__main__':
     main()
-